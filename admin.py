@@ -0,0 +1,324 @@
+import hmac
+import warnings
+from flask import flash, redirect, url_for, request, g, current_app, Response
+from flask_login import current_user
+from wtforms import PasswordField
+from wtforms.validators import InputRequired, Email, Length, Optional, AnyOf
+from flask_admin import Admin, BaseView, expose
+from flask_admin.base import MenuLink
+from flask_admin.actions import action
+from flask_admin.contrib.sqla import ModelView, tools
+from flask_admin.form import rules
+from sqlalchemy import func, and_
+from sqlalchemy.orm import joinedload
+
+from extensions import db, background_jobs, metrics, profiler
+from models import User, Ulog, Uaction, Tcategory, invalidate_user, invalidate_default_tcategories, uactions, \
+    invalidate_reference_data
+from helpers import start_user_deletion
+
+
+# Flask Admin configuration
+# User log model View (index page)
+# the log grows to millions of rows: no COUNT(*) (estimated counts), search only as indexed user id / details prefix
+# matches and keyset pagination by id along the primary key / ix_ulog_user_id ("cursor" = id of the last row shown)
+# ids increase with the timestamp, unlike the timestamps they have one format in every database (sqlite stores
+# CURRENT_TIMESTAMP without, datetime values with microseconds)
+class UlogModelView(ModelView):
+    can_create = False
+    can_edit = False
+    can_delete = False
+    column_list = ('timestamp', 'uaction.name', 'uaction.loglevel', 'user_id', 'details')
+    column_labels = {'uaction.name': 'Action', 'uaction.loglevel': 'Log Level'}
+    column_filters = ('uaction.loglevel', 'uaction.name', 'user_id')
+    # action name / log level from the cached user actions instead of a join
+    column_auto_select_related = False
+    column_formatters = {'uaction.name': lambda view, context, model, name: view.uaction(model).name,
+                         'uaction.loglevel': lambda view, context, model, name: view.uaction(model).loglevel}
+    column_searchable_list = ('details',)
+    column_sortable_list = ('timestamp',)
+    column_default_sort = ('timestamp', True)
+    list_template = 'admin/ulog_list.html'
+    simple_list_pager = True
+    # filtered counts stop at count_limit rows
+    count_limit = 1000
+
+    # # https://github.com/flask-admin/flask-admin/issues/580
+    def __init__(self, model, session, *args, **kwargs):
+        super(UlogModelView, self).__init__(model, session, *args, **kwargs)
+        self.static_folder = 'static'
+
+    # Allow access for a certain user level
+    def is_accessible(self):
+        if current_user.is_authenticated:
+            return current_user.level == 'admin'
+
+    # redirect to login if not logged in
+    def inaccessible_callback(self, name, **kwargs):
+        if not self.is_accessible():
+            flash('You don\'t have the necceary permission')
+            return redirect(url_for('auth.login', next=request.url))
+
+    # actions added since the cache was loaded are read from the row
+    @staticmethod
+    def uaction(model):
+        return uactions().get(model.action_id) or model.uaction
+
+    # search: a number matches the user id, anything else is a prefix of details (index range, no LIKE '%...%')
+    def search_criterion(self, search):
+        search = search.strip()
+        if search.isdigit():
+            return self.model.user_id == int(search)
+        return and_(self.model.details >= search, self.model.details < search + '\U0010ffff')
+
+    # cursor (id of a row) -> id, None if missing or invalid
+    @staticmethod
+    def parse_cursor(cursor):
+        try:
+            return int(cursor)
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def make_cursor(row):
+        return str(row.id)
+
+    # rows in the table (estimated) or matching rows up to count_limit, as text for the list page
+    def estimate_count(self, query, filtered):
+        if filtered:
+            count = self.session.query(func.count()).select_from(query.limit(self.count_limit + 1).subquery()).scalar()
+            return f'more than {self.count_limit}' if count > self.count_limit else str(count)
+        if self.session.bind.dialect.name == 'postgresql':
+            count = self.session.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = 'ulog'").scalar()
+        else:
+            count = self.session.query(func.max(self.model.id)).scalar()
+        return f'about {count or 0}'
+
+    # keyset instead of offset pagination, the page argument is ignored (sorted by timestamp = sorted by id)
+    def get_list(self, page, sort_column, sort_desc, search, filters, execute=True, page_size=None):
+        query = self.get_query()
+        joins = {}
+        if search:
+            query = query.filter(self.search_criterion(search))
+        if filters and self._filters:
+            query, _, joins, _ = self._apply_filters(query, None, joins, {}, filters)
+        g.ulog_count = self.estimate_count(query, bool(search or filters))
+        for j in self._auto_joins:
+            query = query.options(joinedload(j))
+
+        descending = sort_desc if sort_column is not None else True
+        cursor = self.parse_cursor(request.args.get('cursor'))
+        if cursor is not None:
+            query = query.filter(self.model.id < cursor if descending else self.model.id > cursor)
+        query = query.order_by(self.model.id.desc() if descending else self.model.id)
+        query = query.limit(page_size or self.page_size)
+        return None, query.all() if execute else query
+
+    def render(self, template, **kwargs):
+        if template == self.list_template:
+            args = request.args.to_dict()
+            args.pop('cursor', None)
+            args.pop('page', None)
+            data = kwargs.get('data') or []
+            kwargs.update(estimated_count=g.get('ulog_count'),
+                          first_url=url_for('.index_view', **args) if 'cursor' in request.args else None,
+                          next_url=(url_for('.index_view', cursor=self.make_cursor(data[-1]), **args)
+                                    if len(data) == kwargs.get('page_size') else None))
+        return super(UlogModelView, self).render(template, **kwargs)
+
+
+# User view
+class UserModelView(ModelView):
+    column_exclude_list = 'password_hash'
+    form_excluded_columns = 'password_hash'
+    column_searchable_list = ('email',)
+    column_filters = ('level',)
+    column_sortable_list = ('email', 'lastlogin')
+    column_default_sort = ('lastlogin', True)
+    form_columns = ('email', 'level', 'password_hash')
+    # evtl. adding additional table with user roles makes sense
+    form_choices = dict(
+        level=[('user', 'user'), ('admin', 'admin'), ]
+    )
+    form_args = dict(
+        email=dict(validators=[Email()]),
+        level=dict(validators=[AnyOf(['user', 'admin'])]),
+
+    )
+    form_edit_rules = ('email', 'level', rules.Header('Reset Password'), 'new_password', 'confirm')
+    form_create_rules = ('email', 'level', 'password')
+
+    # Allow access for a certain user level
+    def is_accessible(self):
+        if current_user.is_authenticated:
+            return current_user.level == 'admin'
+
+    # redirect to login if not logged in
+    def inaccessible_callback(self, name, **kwargs):
+        if not self.is_accessible():
+            flash('You don\'t have the necceary permission')
+            return redirect(url_for('auth.login', next=request.url))
+
+    # extend form with additional password fields not contained in model (necessary for password handling)
+    def scaffold_form(self):
+        form_class = super(UserModelView, self).scaffold_form()
+        form_class.password = PasswordField('Password', validators=[InputRequired(), Length(min=4, max=50)])
+        form_class.new_password = PasswordField('New Password', validators=[Optional(), Length(min=4, max=50)])
+        form_class.confirm = PasswordField('Confirm New Password')
+        return form_class
+
+    # define "create" form
+    def create_model(self, form):
+        model = self.model()
+        form.populate_obj(model)
+        model.set_password(form.password.data)
+        self.session.add(model)
+        self._on_model_change(form, model, True)
+        self.session.commit()
+        flash('New user created')
+
+    # define "edit" form
+    def update_model(self, form, model):
+        form.populate_obj(model)
+        if form.new_password.data:
+            if form.new_password.data != form.confirm.data:
+                flash('Passwords must match')
+                return
+            model.set_password(form.new_password.data)
+            flash('Password changed')
+        self.session.add(model)
+        self._on_model_change(form, model, False)
+        self.session.commit()
+        invalidate_user(model.id)
+        flash('Changes saved')
+
+    # users are deleted by a background job in chunks (progress: Jobs)
+    # returns False: the user still exists, Flask-Admin must not report the record as deleted
+    def delete_model(self, model):
+        start_user_deletion(model.id, model.email)
+        flash(f'Deletion of user {model.email} started, see Jobs for the progress')
+        return False
+
+    # one deletion job per selected user (instead of counting deleted records)
+    @action('delete', 'Delete', 'Are you sure you want to delete the selected users?')
+    def action_delete(self, ids):
+        for model in tools.get_query_for_ids(self.get_query(), self.model, ids):
+            self.delete_model(model)
+
+
+# Transaction category view
+class TcategoryModelView(ModelView):
+    column_list = ('name', 'ttype.name')
+    column_labels = {'ttype.name': 'Transaction Type'}
+    form_excluded_columns = ('user', 'transactions', 'deleted')
+    form_args = dict(
+        default=dict(default=True, validators=[InputRequired()]),
+    )
+
+    def get_query(self):
+        return self.session.query(self.model).filter(self.model.default == True)
+
+    # new users get a copy of the default categories (cached template)
+    def after_model_change(self, form, model, is_created):
+        invalidate_default_tcategories()
+
+    def after_model_delete(self, model):
+        invalidate_default_tcategories()
+
+    # Allow access for a certain user level
+    def is_accessible(self):
+        if current_user.is_authenticated:
+            return current_user.level == 'admin'
+
+    # redirect to login if not logged in
+    def inaccessible_callback(self, name, **kwargs):
+        if not self.is_accessible():
+            flash('You don\'t have the necceary permission')
+            return redirect(url_for('auth.login', next=request.url))
+
+
+# Background jobs of this worker process (user deletions, attachment purges)
+# the jobs are kept in memory of the process which started them: with several worker processes (gunicorn -w) the
+# page only lists the jobs of the worker serving the request and may be empty while a job runs in another worker
+class JobsView(BaseView):
+    @expose('/')
+    def index(self):
+        return self.render('admin/jobs.html', jobs=background_jobs.list())
+
+    # Allow access for a certain user level
+    def is_accessible(self):
+        if current_user.is_authenticated:
+            return current_user.level == 'admin'
+
+    # redirect to login if not logged in
+    def inaccessible_callback(self, name, **kwargs):
+        if not self.is_accessible():
+            flash('You don\'t have the necceary permission')
+            return redirect(url_for('auth.login', next=request.url))
+
+
+# Request metrics of this worker process in prometheus text format (only with INSTRUMENTATION)
+# scrapers authenticate with "Authorization: Bearer <METRICS_TOKEN>"
+class MetricsView(BaseView):
+    @expose('/')
+    def index(self):
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    # most frequent stacks of the last slow requests (PROFILE_SLOW_REQUESTS)
+    @expose('/slow')
+    def slow(self):
+        return Response('\n\n'.join(profiler.reports) or 'no slow requests\n', mimetype='text/plain')
+
+    # Allow access for a certain user level (or the metrics token)
+    def is_accessible(self):
+        token = current_app.config['METRICS_TOKEN']
+        if token and hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode()):
+            return True
+        if current_user.is_authenticated:
+            return current_user.level == 'admin'
+
+    # redirect to login if not logged in
+    def inaccessible_callback(self, name, **kwargs):
+        if not self.is_accessible():
+            flash('You don\'t have the necceary permission')
+            return redirect(url_for('auth.login', next=request.url))
+
+
+# Generic view for views without special needs
+class GenModelView(ModelView):
+    can_create = False
+    can_delete = False
+    column_exclude_list = ('ttype',)
+    form_excluded_columns = ('ulog', 'tcategories')
+
+    # user actions are cached (see uactions in models.py)
+    def after_model_change(self, form, model, is_created):
+        invalidate_reference_data()
+
+    # Allow access for a certain user level
+    def is_accessible(self):
+        if current_user.is_authenticated:
+            return current_user.level == 'admin'
+
+    # redirect to login if not logged in
+    def inaccessible_callback(self, name, **kwargs):
+        if not self.is_accessible():
+            flash('You don\'t have the necceary permission')
+            return redirect(url_for('auth.login', next=request.url))
+
+
+# Inititate the Flask-Admin Interface (called by create_app, only if the ADMIN config is enabled)
+def init_admin(app):
+    admin = Admin(app, name='Budgy Admin',
+                  index_view=UlogModelView(Ulog, db.session, name='User Log',
+                                           url='/admin', endpoint='admin'), template_mode='bootstrap3')
+    admin.add_link(MenuLink(name='Back to Budgy', url=app.config['WWW_SUBPATH'] + '/'))
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', 'Fields missing from ruleset')
+        admin.add_view(UserModelView(User, db.session, 'Users'))
+    admin.add_view(TcategoryModelView(Tcategory, db.session, 'Default Transaction Categories'))
+    admin.add_view(GenModelView(Uaction, db.session, 'User actions'))
+    admin.add_view(JobsView(name='Jobs', endpoint='jobs'))
+    if app.config['INSTRUMENTATION']:
+        admin.add_view(MetricsView(name='Metrics', endpoint='metrics'))
+    return admin
@@ -0,0 +1,74 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from workers import PerProcess, start_thread, thread_alive
+
+logger = logging.getLogger(__name__)
+
+
+# Background writer for user log entries
+# entries are queued by the request threads and written in batches (batch_size entries or every flush_interval
+# seconds) by a worker thread. If the queue is full new entries are dropped (and counted) instead of blocking
+# the request. Remaining entries are flushed on shutdown.
+class LogWriter(object):
+    def __init__(self, write_batch, queue_size=10000, batch_size=100, flush_interval=1.0):
+        self.write_batch = write_batch
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.written = 0
+        self.lock = threading.Lock()
+        self.worker = PerProcess(lambda: start_thread(self.run, 'ulog-writer'), thread_alive)
+        atexit.register(self.close)
+
+    def put(self, entry):
+        self.start()
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+                dropped = self.dropped
+            if dropped == 1 or dropped % 1000 == 0:
+                logger.warning('user log queue full, %s entries dropped so far', dropped)
+
+    def start(self):
+        self.worker.get()
+
+    def run(self):
+        while True:
+            batch = []
+            deadline = time.time() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    entry = self.queue.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if entry is None:
+                    stop = True
+                    break
+                batch.append(entry)
+            if batch:
+                self.flush(batch)
+            if stop:
+                return
+
+    def flush(self, batch):
+        try:
+            self.write_batch(batch)
+            self.written += len(batch)
+        except Exception:
+            logger.exception('writing %s user log entries failed', len(batch))
+
+    # write the remaining entries and stop the worker
+    def close(self, timeout=10):
+        thread = self.worker.current()
+        if thread is None:
+            return
+        self.queue.put(None)
+        thread.join(timeout)
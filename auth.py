@@ -0,0 +1,134 @@
+from flask import Blueprint, current_app, flash, redirect, render_template, url_for, request
+from flask_login import login_required, current_user, login_user, logout_user
+from flask_wtf import FlaskForm
+from wtforms import StringField, PasswordField, BooleanField, SubmitField
+from wtforms.validators import InputRequired, Email, Length, EqualTo
+
+from extensions import db, login_throttle
+from models import User, invalidate_user
+from helpers import add_user_log, login_timestamp, client_ip
+
+auth = Blueprint('auth', __name__)
+
+
+# Flask Form classes
+# User Login
+class LoginForm(FlaskForm):
+    email = StringField('email', validators=[Email()], render_kw={"placeholder": "email"})
+    password = PasswordField("password", validators=[InputRequired(), Length(min=4, max=50)],
+                             render_kw={"placeholder": "Password"})
+    remember_me = BooleanField('remember me')
+    submit = SubmitField('Login')
+
+
+# User change password
+class ChangePwForm(FlaskForm):
+    password = PasswordField("password", validators=[InputRequired(), Length(min=4, max=50)],
+                             render_kw={"placeholder": "Existing Password"})
+    new_password = PasswordField('password',
+                                 validators=[InputRequired(), EqualTo('confirm', 'New Passwords must match'),
+                                             Length(min=1, max=50)], render_kw={"placeholder": "New Password"})
+    confirm = PasswordField('confirm', validators=[InputRequired()], render_kw={"placeholder": "Confirm New Password"})
+    submit = SubmitField('Reset password')
+
+
+# User Registration
+class RegistrationForm(FlaskForm):
+    email = StringField('email', validators=[Email()], render_kw={"placeholder": "Email"})
+    password = PasswordField('password', validators=[InputRequired(), EqualTo('confirm', 'Passwords must match'),
+                                                     Length(min=1, max=50)], render_kw={"placeholder": "Password"})
+    confirm = PasswordField('confirm', validators=[InputRequired()], render_kw={"placeholder": "Confirm Password"})
+    submit = SubmitField('Register')
+
+
+# Routes
+@auth.route('/login', methods=['GET', 'POST'])
+def login():
+    if current_user.is_authenticated:
+        return redirect(url_for('main.index'))
+    form = LoginForm()
+    if form.validate_on_submit():
+        ip = client_ip()
+        throttle = current_app.config['LOGIN_THROTTLE']
+        # too many failed logins: rejected before the password check and any db access, logged in summary
+        if throttle and login_throttle.blocked(form.email.data, ip):
+            attempts = login_throttle.rejected(form.email.data, ip)
+            if attempts:
+                add_user_log(2, f'throttled: {attempts} attempts for {form.email.data} from {ip}'[:120])
+            flash('Too many failed logins, please try again later')
+            return render_template('user_login.html', title='Login', form=form), 429
+        row = User.query.filter_by(email=form.email.data).first()
+        if row is None or not row.check_password(form.password.data):
+            if throttle:
+                login_throttle.failed(form.email.data, ip)
+            flash('Invalid email or password')
+            if row:
+                add_user_log(2, f'user: {row.email}', user_id=row.id)
+            else:
+                add_user_log(2, f'unknown user: {form.email.data}')
+            return redirect(url_for('.login'))
+        # upgrade the hash to the configured method (saved by login_timestamp)
+        if row.password_needs_rehash():
+            row.set_password(form.password.data)
+        login_user(row, remember=form.remember_me.data)
+        add_user_log(1, f'user: {row.email}')
+        login_timestamp()
+        flash('Successfully logged in')
+        return redirect(request.args.get('next') or url_for('main.index'))
+    return render_template('user_login.html', title='Login', form=form)
+
+
+@auth.route('/change_passwd', methods=['GET', 'POST'])
+@login_required
+def change_passwd():
+    form = ChangePwForm()
+    if form.validate_on_submit():
+        row = User.query.filter_by(id=current_user.id).one()
+        if not row.check_password(form.password.data):
+            flash('Invalid existing password')
+            return redirect(url_for('.change_passwd'))
+        row.set_password(form.new_password.data)
+        db.session.add(row)
+        db.session.commit()
+        invalidate_user(row.id)
+        flash('Password reset successful')
+        return redirect(request.args.get('next') or url_for('main.index'))
+    return render_template('user_passwd.html', title='Set password', form=form)
+
+
+@auth.route('/logout')
+@login_required
+def logout():
+    logout_user()
+    return redirect(url_for('.login'))
+
+
+@auth.route('/register', methods=['GET', 'POST'])
+def register():
+    # add user to database if not existing
+    form = RegistrationForm()
+    if form.validate_on_submit():
+        row = User(email=form.email.data, level='user')
+        # Verify if user already exists
+        user_exist = User.query.filter_by(email=form.email.data).first()
+        if user_exist and user_exist.email == row.email:
+            add_user_log(4, f'user already registered: {form.email.data}')
+            flash('User already registered')
+        else:
+            # add user to db and login user
+            db.session.add(row)
+            row.set_password(form.password.data)
+            db.session.commit()
+            flash('Registration successful')
+            login_user(row)
+            login_timestamp()
+            add_user_log(3, f'user: {form.email.data}')
+
+            # copy default data to user (to provide later adjustments)
+            # see
+
+            # redirect user to index
+            return redirect(url_for('main.index'))
+
+    # render register form
+    return render_template('user_register.html', title='Register', form=form)
@@ -0,0 +1,162 @@
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+
+# In-process LRU backend
+# (versions live in the worker process - with several workers use SharedBackend to avoid stale pages)
+class LRUBackend(object):
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        # versions are never evicted, otherwise an old version (and its pages) could come back
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def version(self, name):
+        return self.versions.get(name, 0)
+
+    def bump(self, name):
+        with self.lock:
+            self.versions[name] = self.versions.get(name, 0) + 1
+
+
+# Shared backend on top of a redis like client (get, set with ex=<seconds>, incr)
+class SharedBackend(object):
+    def __init__(self, client, timeout=3600, prefix='budgy:'):
+        self.client = client
+        self.timeout = timeout
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=self.timeout)
+
+    def version(self, name):
+        value = self.client.get(self.prefix + 'version:' + name)
+        if value is None:
+            # start (or restart after an eviction) above every version handed out before
+            value = int(time.time() * 1000)
+            self.client.set(self.prefix + 'version:' + name, value)
+        return int(value)
+
+    def bump(self, name):
+        self.version(name)
+        self.client.incr(self.prefix + 'version:' + name)
+
+
+# Local stand-in for a redis client (tests / single host setups), implements the subset used by the shared backends
+class LocalClient(object):
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value, expires = self.values.get(key, (None, None))
+            if expires and expires < time.time():
+                del self.values[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None):
+        with self.lock:
+            self.values[key] = (value, time.time() + ex if ex else None)
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def incr(self, key):
+        with self.lock:
+            value, expires = self.values.get(key, (0, None))
+            if expires and expires < time.time():
+                value, expires = 0, None
+            self.values[key] = (int(value) + 1, expires)
+            return int(value) + 1
+
+    def expire(self, key, seconds):
+        with self.lock:
+            if key in self.values:
+                self.values[key] = (self.values[key][0], time.time() + seconds)
+
+
+# Small in-process cache with expiring entries
+class TTLCache(object):
+    def __init__(self, ttl=60, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value, expires = self.entries.get(key, (None, 0))
+            if expires < time.time():
+                self.entries.pop(key, None)
+                return None
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            if len(self.entries) >= self.max_entries:
+                now = time.time()
+                self.entries = {k: v for k, v in self.entries.items() if v[1] >= now}
+                if len(self.entries) >= self.max_entries:
+                    self.entries.clear()
+            self.entries[key] = (value, time.time() + self.ttl)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+# Page cache keyed by (user_id, route, view_args, query_args, period, data_version)
+# period: part of the key for pages depending on the date (e.g. the current month), entries do not expire
+class PageCache(object):
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    # view_args: dict of the url arguments (values of any type, e.g. None defaults), query_args: (name, value) strings
+    def key(self, user_id, route, view_args, query_args, period=''):
+        data_version = self.backend.version(f'user:{user_id}')
+        view_args = sorted((name, repr(value)) for name, value in view_args.items())
+        return f'page:{user_id}:{route}:{view_args}:{sorted(query_args)}:{period}:{data_version}'
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+
+    # invalidate all pages of the user (call after every change of the users data)
+    def bump(self, user_id):
+        self.backend.bump(f'user:{user_id}')
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_ratio': self.hits / requests if requests else 0}
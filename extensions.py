@@ -0,0 +1,69 @@
+import sqlite3
+from flask import current_app, has_app_context
+from flask_sqlalchemy import SQLAlchemy
+from flask_login import LoginManager
+# flask-uploads uses werkzeugs secure_filename
+from flask_uploads import UploadSet
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from cache import PageCache, LRUBackend, TTLCache
+from jobs import JobRunner
+from metrics import Metrics, SamplingProfiler
+from passwords import PasswordHasher
+from previews import PreviewGenerator
+from throttle import LoginThrottle, LocalBackend
+
+
+# Extensions are created unbound and initialized by create_app (application.py)
+
+# Flask-SQLAlchemy 2.3 has no config option for pre-ping and passes pool sizes to sqlite as well
+class Database(SQLAlchemy):
+    def apply_driver_hacks(self, app, info, options):
+        if info.drivername.startswith('sqlite'):
+            for option in ('pool_size', 'max_overflow', 'pool_timeout'):
+                options.pop(option, None)
+        super(Database, self).apply_driver_hacks(app, info, options)
+        options['pool_pre_ping'] = app.config['SQLALCHEMY_POOL_PRE_PING']
+
+
+db = Database()
+# Flask Login
+login = LoginManager()
+login.login_view = 'auth.login'
+uploaded_receipts = UploadSet('receipts')
+# thumbnails / previews of receipt images - sizes and pool are set by create_app (RECEIPT_PREVIEW_* config)
+receipt_previews = PreviewGenerator()
+# page cache - backend is set by create_app (PAGE_CACHE_BACKEND or in-process LRU)
+page_cache = PageCache(LRUBackend())
+# logged in users (see load_user in models.py)
+user_cache = TTLCache()
+# password hashing - method and pool are set by create_app (PASSWORD_HASH_* config)
+password_hasher = PasswordHasher()
+# failed login throttle - backend and limits are set by create_app (LOGIN_THROTTLE_* config)
+login_throttle = LoginThrottle(LocalBackend())
+# background jobs (user deletion, attachment purge), listed in the admin interface
+background_jobs = JobRunner()
+# default categories copied to new users (see default_tcategory_template in models.py)
+default_tcategory_cache = TTLCache()
+# request metrics and slow request profiler (INSTRUMENTATION / PROFILE_* config, see metrics.py)
+metrics = Metrics()
+profiler = SamplingProfiler()
+# transaction types and user actions (see ttypes / uactions in models.py)
+reference_cache = TTLCache()
+# active categories per user (see user_tcategories in models.py) - size is set by create_app (TCATEGORY_CACHE_SIZE)
+tcategory_cache = LRUBackend()
+
+
+# WAL (readers do not block the writer), less fsyncs, wait for locks instead of failing, larger page cache
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    config = current_app.config if has_app_context() else {}
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA busy_timeout={}'.format(config.get('SQLITE_BUSY_TIMEOUT', 5000)))
+    cursor.execute('PRAGMA cache_size=-{}'.format(config.get('SQLITE_CACHE_SIZE', 20000)))
+    cursor.close()
@@ -0,0 +1,433 @@
+import csv
+import hashlib
+import io
+import json
+import os
+import tempfile
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from functools import wraps
+from flask import current_app, request, session, abort, has_request_context
+from flask_login import current_user
+from sqlalchemy import func, extract, select
+from sqlalchemy.exc import IntegrityError
+from werkzeug.utils import secure_filename
+
+from extensions import db, page_cache, uploaded_receipts, background_jobs
+from models import User, Ulog, Transaction, Tcategory, Ttype, Receipt, MonthlyCategoryTotal, update_monthly_total, \
+    invalidate_user, purge_user_files, amount_in_range, MAX_AMOUNT
+from previews import variant_name
+
+
+# serve the rendered page from the page cache, key contains the users data_version (bumped on every change)
+# and the current month (charts / overviews of the actual month are rendered again after the month rollover)
+def cached_page(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # pages with pending flash messages are neither served from nor stored in the cache
+        if not current_app.config['PAGE_CACHE'] or session.get('_flashes'):
+            return view(*args, **kwargs)
+        key = page_cache.key(current_user.id, request.endpoint, kwargs, request.args.items(multi=True),
+                             datetime.now().strftime('%Y-%m'))
+        page = page_cache.get(key)
+        if page is None:
+            page = view(*args, **kwargs)
+            page_cache.set(key, page)
+        return page
+    return wrapper
+
+
+# add user login timestamp
+def login_timestamp():
+    row = User.query.filter_by(id=current_user.id).one()
+    row.lastlogin = func.now()
+    db.session.add(row)
+    db.session.commit()
+
+
+# client address (see PROXY_FORWARDED_FOR)
+def client_ip():
+    forwarded_for = current_app.config['PROXY_FORWARDED_FOR']
+    if forwarded_for is None:
+        forwarded_for = request.environ.get('budgy.proxied', False)
+    if forwarded_for and request.access_route:
+        return request.access_route[-1]
+    return request.remote_addr or ''
+
+
+# store an uploaded receipt once per user and content, returns the attachment name "<user_id>/<sha256><ext>"
+# the upload is copied to a temporary file in chunks while hashing, duplicates of a stored file are discarded.
+# The receipt row is flushed before the file is moved into place and before the transaction, whose insert / update
+# listener counts the reference.
+def save_receipt(user_id, storage, chunk_size=64 * 1024):
+    directory = os.path.join(current_app.config['UPLOADED_RECEIPTS_DEST'], str(user_id))
+    os.makedirs(directory, exist_ok=True)
+    sha256 = hashlib.sha256()
+    size = 0
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in iter(lambda: storage.stream.read(chunk_size), b''):
+                sha256.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        receipt = receipt_row(user_id, sha256.hexdigest(), size, storage.filename)
+        path = os.path.join(current_app.config['UPLOADED_RECEIPTS_DEST'], receipt.name)
+        if os.path.exists(path):
+            os.remove(temp_path)
+        else:
+            os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return receipt.name
+
+
+# receipt row of a user and content, added if there is none yet. A concurrent upload of the same content can insert
+# it between the query and the insert (uq_receipt_user_id_sha256): the insert runs in a savepoint and the row of the
+# other upload is used when it fails
+def receipt_row(user_id, sha256, size, filename):
+    receipt = Receipt.query.filter_by(user_id=user_id, sha256=sha256).first()
+    if receipt is None:
+        extension = os.path.splitext(secure_filename(filename or ''))[1].lower()
+        receipt = Receipt(user_id=user_id, sha256=sha256, size=size, refcount=0, modified=func.now(),
+                          name=f'{user_id}/{sha256}{extension}')
+        try:
+            with db.session.begin_nested():
+                db.session.add(receipt)
+            return receipt
+        except IntegrityError:
+            receipt = Receipt.query.filter_by(user_id=user_id, sha256=sha256).one()
+    # keeps the file from being cleaned up until the transaction references it
+    receipt.modified = func.now()
+    db.session.flush()
+    return receipt
+
+
+# url of a receipt variant (thumb, preview), None until the background job has created it
+def receipt_variant_url(attachment_name, variant):
+    if attachment_name and variant in current_app.config['RECEIPT_PREVIEW_SIZES'] and \
+            os.path.exists(os.path.join(current_app.config['UPLOADED_RECEIPTS_DEST'],
+                                        variant_name(attachment_name, variant))):
+        return uploaded_receipts.url(variant_name(attachment_name, variant))
+
+
+# User Log entries
+def add_user_log(action_id, details, **kwargs):
+
+    user_id = kwargs.get('user_id', None)
+
+    # no logged in user outside of requests (manage.py commands)
+    if has_request_context() and current_user.is_authenticated:
+        user_id = current_user.id
+    elif user_id:
+        user_id = user_id
+    else:
+        user_id = None
+
+    if current_app.config['ULOG_ASYNC']:
+        # utc like the CURRENT_TIMESTAMP default of the synchronous path
+        current_app.extensions['ulog_writer'].put(dict(timestamp=datetime.utcnow(), action_id=action_id,
+                                                       user_id=user_id, details=details))
+    else:
+        row = Ulog(timestamp=func.now(), action_id=action_id, user_id=user_id, details=details)
+        db.session.add(row)
+        db.session.commit()
+
+
+# write a batch of user log entries (called by the background log writer, see create_app)
+def write_user_logs(app, entries):
+    with app.app_context():
+        db.engine.execute(Ulog.__table__.insert(), entries)
+
+
+# half-open date range [start, end) of a calendar month (index friendly, unlike extract('month', ...))
+def month_range(year, month):
+    return datetime(year, month, 1), datetime(year + month // 12, month % 12 + 1, 1)
+
+
+# base query for a users transactions, optionally restricted to a transaction type and a date range [start, end)
+def user_transactions(user_id, ttype_id=None, start=None, end=None):
+    query = Transaction.query.filter(Transaction.user_id == user_id)
+    if ttype_id:
+        query = query.join(Tcategory).filter(Tcategory.ttype_id == ttype_id)
+    if start:
+        query = query.filter(Transaction.date >= start)
+    if end:
+        query = query.filter(Transaction.date < end)
+    return query
+
+
+# "YYYY-MM" query parameter -> (year, month)
+def parse_month(value):
+    try:
+        month = datetime.strptime(value, '%Y-%m')
+    except ValueError:
+        abort(400)
+    return month.year, month.month
+
+
+# "YYYY-MM-DD" query parameter -> datetime
+def parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        abort(400)
+
+
+# label of the analytics period (month, quarter, year) containing the given month
+def period_label(period, year, month):
+    if period == 'month':
+        return f'{year}-{month:02d}'
+    if period == 'quarter':
+        return f'{year}-Q{(month - 1) // 3 + 1}'
+    return str(year)
+
+
+# keyset pagination cursor for transaction lists -> "<date as %Y%m%d%H%M%S>_<transaction id>"
+def encode_cursor(row):
+    return '{}_{}'.format(row.date.strftime('%Y%m%d%H%M%S'), row.id)
+
+
+def decode_cursor(cursor):
+    try:
+        cursor_date, cursor_id = cursor.split('_')
+        return datetime.strptime(cursor_date, '%Y%m%d%H%M%S'), int(cursor_id)
+    except ValueError:
+        abort(400)
+
+
+# group a page of transactions (ordered by date desc) into months and attach the month totals computed in sql
+def month_groups(query, rows):
+    if not rows:
+        return []
+    # totals cover complete months, even if the page only contains part of a month
+    start = month_range(rows[-1].date.year, rows[-1].date.month)[0]
+    end = month_range(rows[0].date.year, rows[0].date.month)[1]
+    year = extract('year', Transaction.date).label('year')
+    month = extract('month', Transaction.date).label('month')
+    totals = query.filter(Transaction.date >= start, Transaction.date < end)\
+                  .with_entities(year, month, func.sum(Transaction.amount), func.count(Transaction.id))\
+                  .group_by(year, month).all()
+    totals = {(int(y), int(m)): (total, count) for y, m, total, count in totals}
+
+    groups = []
+    for row in rows:
+        key = (row.date.year, row.date.month)
+        if not groups or groups[-1]['key'] != key:
+            total, count = totals.get(key, (0, 0))
+            groups.append({'key': key, 'label': row.date.strftime('%B-%Y'), 'total': total, 'count': count,
+                           'rows': []})
+        groups[-1]['rows'].append(row)
+    return groups
+
+
+# Transaction export
+EXPORT_COLUMNS = ['id', 'date', 'type', 'category', 'amount', 'details', 'attachment_name', 'geo_lat', 'geo_lng']
+
+
+# plain rows (no ORM objects) of a users transactions in [start, end), fetched in chunks of yield_per rows
+# (server side cursor where the driver supports it), so memory does not grow with the number of rows
+def export_rows(user_id, start=None, end=None, yield_per=1000):
+    query = user_transactions(user_id, start=start, end=end)\
+        .join(Transaction.tcategory).join(Tcategory.ttype)\
+        .with_entities(Transaction.id, Transaction.date, Ttype.name, Tcategory.name, Transaction.amount,
+                       Transaction.details, Transaction.attachment_name, Transaction.geo_lat, Transaction.geo_lng)\
+        .order_by(Transaction.date, Transaction.id)
+    return query.yield_per(yield_per)
+
+
+# csv lines, flushed every chunk_size rows
+def csv_stream(rows, chunk_size=1000):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+# newline delimited json, one object per transaction
+def ndjson_stream(rows, chunk_size=1000):
+    lines = []
+    for row in rows:
+        item = dict(zip(EXPORT_COLUMNS, row))
+        item['date'] = item['date'].isoformat()
+        if item['amount'] is not None:
+            item['amount'] = float(item['amount'])
+        lines.append(json.dumps(item) + '\n')
+        if len(lines) >= chunk_size:
+            yield ''.join(lines)
+            lines = []
+    yield ''.join(lines)
+
+
+EXPORT_FORMATS = {'csv': (csv_stream, 'text/csv'), 'ndjson': (ndjson_stream, 'application/x-ndjson')}
+
+
+# Transaction import
+# csv with a header row, columns as in the export (date, type, category, amount, details, geo_lat, geo_lng; other
+# columns are ignored). type may be empty if the category name is unique. The sign of the amount follows the
+# transaction type (expenditures are stored negative, like in transaction_add).
+# "YYYY-MM-DD" or "YYYY-MM-DD HH:MM:SS" (or with "T"), sliced by position - strptime dominated the import time
+def parse_import_date(value):
+    if len(value) not in (10, 19) or value[4] != '-' or value[7] != '-' or \
+            (len(value) == 19 and (value[10] not in ' T' or value[13] != ':' or value[16] != ':')):
+        raise ValueError(f'invalid date {value!r}')
+    if len(value) == 10:
+        return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+    return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]), int(value[11:13]), int(value[14:16]),
+                    int(value[17:19]))
+
+
+# amounts are kept as Decimal until they are stored as cents (see Money in models.py)
+def parse_amount(value):
+    try:
+        amount = Decimal(value.strip())
+    except InvalidOperation:
+        raise ValueError(f'invalid amount {value!r}')
+    if not amount_in_range(amount):
+        raise ValueError(f'invalid amount {value!r} (at most {MAX_AMOUNT})')
+    return amount
+
+
+def optional_float(value):
+    return float(value) if value else None
+
+
+# lines: iterable of text lines (file object, decoded upload stream), parsed one row at a time
+# rows are inserted with core executemany inserts of chunk_size rows, all in one database transaction: a file which
+# cannot be decoded or parsed raises ValueError and nothing is imported
+# returns (number of imported rows, [(line number, error), ...]), invalid rows are skipped
+def import_transactions(user_id, lines, chunk_size=1000, max_errors=100):
+    # category lookup: (type, category) -> (tcategory_id, ttype_id), category -> ... if the name is unique
+    categories = {}
+    names = {}
+    rows = db.session.query(Tcategory.id, Tcategory.name, Ttype.id, Ttype.name).join(Tcategory.ttype)\
+                     .filter(Tcategory.user_id == user_id, Tcategory.deleted.is_(None)).all()
+    for tcategory_id, name, ttype_id, ttype_name in rows:
+        categories[(ttype_name.lower(), name.lower())] = (tcategory_id, ttype_id)
+        names[name.lower()] = None if name.lower() in names else (tcategory_id, ttype_id)
+
+    errors = []
+    try:
+        imported = import_rows(user_id, csv.DictReader(lines), categories, names, errors, chunk_size, max_errors)
+    except UnicodeDecodeError:
+        db.session.rollback()
+        raise ValueError('file is not UTF-8 encoded')
+    except csv.Error as e:
+        db.session.rollback()
+        raise ValueError(f'invalid csv file: {e}')
+    db.session.commit()
+    if imported:
+        page_cache.bump(user_id)
+        # one summary entry instead of one per transaction
+        add_user_log(5, f'import: {imported} transactions', user_id=user_id)
+    return imported, errors
+
+
+# inserts the valid rows of reader in chunks (not committed), invalid rows are added to errors
+def import_rows(user_id, reader, categories, names, errors, chunk_size, max_errors):
+    imported = 0
+    chunk = []
+    for line_number, row in enumerate(reader, 2):
+        try:
+            ttype_name = (row.get('type') or '').strip().lower()
+            name = (row.get('category') or '').strip().lower()
+            category = categories.get((ttype_name, name)) if ttype_name else names.get(name)
+            if category is None:
+                raise ValueError(f"unknown category {row.get('category')!r}")
+            # columns missing in short rows are None
+            amount = abs(parse_amount(row.get('amount') or ''))
+            chunk.append(dict(date=parse_import_date((row.get('date') or '').strip()), user_id=user_id,
+                              tcategory_id=category[0],
+                              amount=-amount if category[1] == 2 else amount, details=row.get('details') or None,
+                              geo_lat=optional_float(row.get('geo_lat')), geo_lng=optional_float(row.get('geo_lng'))))
+        except (KeyError, TypeError, ValueError) as e:
+            if len(errors) < max_errors:
+                errors.append((line_number, str(e) or 'missing column'))
+            continue
+        if len(chunk) >= chunk_size:
+            imported += insert_transactions(user_id, chunk, commit=False)
+            chunk = []
+    if chunk:
+        imported += insert_transactions(user_id, chunk, commit=False)
+    return imported
+
+
+# insert a chunk of transactions and update the monthly_category_total rollup (core inserts bypass the
+# transaction listeners), committed unless commit is False
+def insert_transactions(user_id, rows, commit=True):
+    totals = {}
+    for row in rows:
+        key = (row['date'].year, row['date'].month, row['tcategory_id'])
+        total, count = totals.get(key, (0, 0))
+        totals[key] = (total + row['amount'], count + 1)
+    connection = db.session.connection()
+    connection.execute(Transaction.__table__.insert(), rows)
+    for (year, month, tcategory_id), (total, count) in totals.items():
+        update_monthly_total(connection, user_id, datetime(year, month, 1), tcategory_id, total, count)
+    if commit:
+        db.session.commit()
+    return len(rows)
+
+
+# User deletion
+# set based deletes of the users rows, transactions in chunks of chunk_size (one db transaction each) instead of
+# loading every child row into the session (ORM cascade). The users log entries are kept without user id (audit
+# trail). The receipts directory is purged after the last commit.
+# every step is idempotent: a failed deletion (locked account) is completed by running it again
+# job: reports the progress (runs in a background job, see start_user_deletion, or directly from manage.py)
+def delete_user(job, user_id, chunk_size=5000):
+    user = User.__table__
+    transaction = Transaction.__table__
+    ulog = Ulog.__table__
+    # lock the account first, no logins while the rows are deleted
+    db.session.execute(user.update().where(user.c.id == user_id).values(password_hash='!'))
+    db.session.commit()
+    invalidate_user(user_id)
+
+    total = db.session.query(func.count(Transaction.id)).filter(Transaction.user_id == user_id).scalar()
+    deleted = 0
+    while True:
+        chunk = select([transaction.c.id]).where(transaction.c.user_id == user_id).limit(chunk_size)
+        count = db.session.execute(transaction.delete().where(transaction.c.id.in_(chunk))).rowcount
+        db.session.commit()
+        if not count:
+            break
+        deleted += count
+        job.progress = f'{deleted} / {total} transactions deleted'
+
+    while True:
+        chunk = select([ulog.c.id]).where(ulog.c.user_id == user_id).limit(chunk_size)
+        count = db.session.execute(ulog.update().where(ulog.c.id.in_(chunk)).values(user_id=None)).rowcount
+        db.session.commit()
+        if not count:
+            break
+        job.progress = f'{deleted} transactions deleted, detaching log entries'
+
+    # core deletes bypass the transaction listeners: rollup and receipt rows are deleted as a whole
+    # (log entries written meanwhile, e.g. failed logins of the locked account, are detached in the same transaction)
+    db.session.execute(ulog.update().where(ulog.c.user_id == user_id).values(user_id=None))
+    for table in (transaction, MonthlyCategoryTotal.__table__, Receipt.__table__, Tcategory.__table__):
+        db.session.execute(table.delete().where(table.c.user_id == user_id))
+    db.session.execute(user.delete().where(user.c.id == user_id))
+    db.session.commit()
+    job.progress = f'{deleted} transactions deleted, purging receipts'
+    purge_user_files(job, current_app.config['UPLOADED_RECEIPTS_DEST'] + str(user_id))
+    job.progress = f'{deleted} transactions deleted, receipts purged'
+
+
+# run delete_user in the background (admin interface)
+def start_user_deletion(user_id, email):
+    app = current_app._get_current_object()
+
+    def run(job):
+        with app.app_context():
+            delete_user(job, user_id, app.config['USER_DELETE_CHUNK_SIZE'])
+    return background_jobs.submit(f'delete user {email}', run)
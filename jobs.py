@@ -0,0 +1,59 @@
+import itertools
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from workers import PerProcess
+
+logger = logging.getLogger(__name__)
+
+
+# State of a background job, shown in the admin interface (Jobs)
+class Job(object):
+    ids = itertools.count(1)
+
+    def __init__(self, name):
+        self.id = next(self.ids)
+        self.name = name
+        self.status = 'queued'
+        self.progress = ''
+        self.error = None
+        self.created = datetime.now()
+        self.finished = None
+
+
+# Background jobs (user deletion, file purges) in a local worker thread
+# jobs are kept per worker process, the last max_jobs of them are listed with their state
+class JobRunner(object):
+    def __init__(self, workers=1, max_jobs=50):
+        self.workers = workers
+        self.jobs = deque(maxlen=max_jobs)
+        self.pool = PerProcess(self.start_pool)
+
+    def start_pool(self):
+        return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='background-job')
+
+    def executor(self):
+        return self.pool.get()
+
+    # function(job, *args) may report its state via job.progress
+    def submit(self, name, function, *args):
+        job = Job(name)
+        self.jobs.appendleft(job)
+        self.executor().submit(self.run, job, function, *args)
+        return job
+
+    def run(self, job, function, *args):
+        job.status = 'running'
+        try:
+            function(job, *args)
+            job.status = 'done'
+        except Exception as e:
+            logger.exception('background job %s failed', job.name)
+            job.status = 'failed'
+            job.error = str(e)
+        job.finished = datetime.now()
+
+    def list(self):
+        return list(self.jobs)
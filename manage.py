@@ -1,9 +1,41 @@
+import csv
+import html
+import http.client
+import io
+import itertools
+import json
+import math
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from functools import partial
+from http.cookies import SimpleCookie
+from random import Random
+from urllib.parse import urlencode
+from flask import current_app
 from flask_script import Manager
+from werkzeug.serving import make_server, WSGIRequestHandler
+from sqlalchemy import func, extract, select, and_, exists
 
-from application import app, db
-from models import User, Uaction, Ttype, Tcategory
+from application import create_app
+from extensions import db, password_hasher
+from jobs import Job
+from previews import variant_name, is_image, make_previews
+from helpers import month_range, user_transactions, parse_date, export_rows, EXPORT_FORMATS, EXPORT_COLUMNS, \
+    import_transactions, insert_transactions, delete_user as delete_user_data
+from models import User, Ulog, Uaction, Ttype, Tcategory, Transaction, MonthlyCategoryTotal, Receipt, invalidate_user, \
+    copy_default_tcategories, invalidate_reference_data, invalidate_user_tcategories, \
+    invalidate_default_tcategories
 
-manager = Manager(app)
+# commands do not need the admin interface and migrations (use FLASK_APP=wsgi.py flask db ... for migrations)
+manager = Manager(partial(create_app, dict(ADMIN=False, MIGRATE=False)))
 
 @manager.command
 # seed default data if table user exists and table is empty
@@ -15,28 +47,17 @@ def init_db():
                        'Registration failed': 'Warning', 'Transaction added': 'Info', 'Transaction changed': 'Info',
                        'Transaction deleted': 'Info', 'Tcategory added': 'Info', 'Tcategory changed': 'Info',
                        'Tcategory deleted': 'Info'}
-            for k, v in actions.items():
-                val = Uaction(name=k, loglevel=v)
-                db.session.add(val)
-                db.session.commit()
-            types = ['Receipts', 'Expenditures']
-            for typ in types:
-                val = Ttype(name=typ)
-                db.session.add(val)
-                db.session.commit()
-            r_cats = ['Sallary', 'Gift', 'Other']
-            for cat in r_cats:
-                val = Tcategory(name=cat, ttype_id=1, default=True)
-                db.session.add(val)
-                db.session.commit()
-            e_cats = ['Sport', 'Car', 'Food']
-            for cat in e_cats:
-                val = Tcategory(name=cat, ttype_id=2, default=True)
-                db.session.add(val)
-                db.session.commit()
+            db.session.add_all(Uaction(name=k, loglevel=v) for k, v in actions.items())
+            db.session.add_all(Ttype(name=typ) for typ in ['Receipts', 'Expenditures'])
+            db.session.add_all(Tcategory(name=cat, ttype_id=1, default=True) for cat in ['Sallary', 'Gift', 'Other'])
+            db.session.add_all(Tcategory(name=cat, ttype_id=2, default=True) for cat in ['Sport', 'Car', 'Food'])
+            # the default categories have to exist before the admin user is inserted (copied by its after_insert)
+            db.session.flush()
+            invalidate_default_tcategories()
             u = User(email='admin@budgy.tld', level='admin')
             db.session.add(u)
             u.set_password('password')
+            # one commit for all rows
             db.session.commit()
             print("records successfully created")
         else:
@@ -45,5 +66,737 @@ def init_db():
         print("Database or required tables do not exist yet")
 
 
+@manager.command
+# verify via EXPLAIN QUERY PLAN (sqlite) that the per user transaction and admin log queries use their indexes
+def check_indexes():
+    start, end = month_range(datetime.now().year, datetime.now().month)
+    # query name -> (query, indexes of which at least one has to be used)
+    transaction_indexes = ('ix_transaction_user_id_date', 'ix_transaction_tcategory_id_date')
+    queries = {
+        'transaction_overview': (user_transactions(1).order_by(Transaction.date.desc(), Transaction.id.desc()),
+                                 transaction_indexes),
+        'transaction_overview (ttype)': (user_transactions(1, 2, start, end)
+                                         .order_by(Transaction.date.desc(), Transaction.id.desc()),
+                                         transaction_indexes),
+        'chart_actual_month': (MonthlyCategoryTotal.query.filter_by(user_id=1, year=start.year, month=start.month),
+                               ('sqlite_autoindex_monthly_category_total_1',)),
+        'user_tcategories': (db.session.query(Tcategory.id, Tcategory.name, Tcategory.ttype_id)
+                             .filter_by(user_id=1, deleted=None).order_by(Tcategory.ttype_id, Tcategory.id),
+                             ('ix_tcategory_user_id_ttype_id',)),
+        'category_overview': (Tcategory.query.filter_by(user_id=1, deleted=None), ('ix_tcategory_user_id_ttype_id',)),
+        'default_tcategory_template': (db.session.query(Tcategory.name, Tcategory.ttype_id)
+                                       .filter(Tcategory.default == True, Tcategory.deleted.is_(None))
+                                       .order_by(Tcategory.id), ('ix_tcategory_default',)),
+        'admin_log (next page)': (Ulog.query.filter(Ulog.id < 1000).order_by(Ulog.id.desc()).limit(20),
+                                  ('INTEGER PRIMARY KEY',)),
+        'admin_log (user)': (Ulog.query.filter(Ulog.user_id == 1, Ulog.id < 1000).order_by(Ulog.id.desc()).limit(20),
+                             ('ix_ulog_user_id',)),
+        'admin_log (search)': (Ulog.query.filter(Ulog.details >= 'login', Ulog.details < 'login\U0010ffff'),
+                               ('ix_ulog_details',)),
+    }
+    failed = False
+    for name, (query, indexes) in queries.items():
+        compiled = query.statement.compile(dialect=db.engine.dialect)
+        params = [compiled.params[key] for key in compiled.positiontup]
+        plan = [row[-1] for row in db.engine.execute('EXPLAIN QUERY PLAN ' + str(compiled), params)]
+        used = any(index in step for step in plan for index in indexes)
+        failed = failed or not used
+        print(f"{name}: {'ok' if used else 'NO INDEX USED'}")
+        for step in plan:
+            print(f"    {step}")
+    if failed:
+        sys.exit(1)
+
+
+@manager.command
+# rebuild the monthly_category_total rollup table from scratch
+def rebuild_monthly_totals():
+    table = MonthlyCategoryTotal.__table__
+    year = extract('year', Transaction.date)
+    month = extract('month', Transaction.date)
+    totals = db.session.query(Transaction.user_id, year, month, Transaction.tcategory_id,
+                              func.coalesce(func.sum(Transaction.amount), 0), func.count(Transaction.id))\
+                       .group_by(Transaction.user_id, year, month, Transaction.tcategory_id)
+    db.session.execute(table.delete())
+    db.session.execute(table.insert().from_select(['user_id', 'year', 'month', 'tcategory_id', 'total', 'count'],
+                                                  totals))
+    db.session.commit()
+    print(f"{MonthlyCategoryTotal.query.count()} monthly totals rebuilt")
+
+
+@manager.command
+# verify that the number of sql statements per route does not grow with the number of transactions
+# (runs against a temporary sqlite database)
+def check_query_counts():
+    current_app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'check.db')
+    current_app.config['WTF_CSRF_ENABLED'] = False
+    current_app.config['QUERY_COUNT'] = True
+    current_app.config['PAGE_CACHE'] = False
+    db.create_all()
+    init_db()
+    user = User(email='check@budgy.tld', level='user')
+    user.set_password('password')
+    db.session.add(user)
+    db.session.commit()
+    user_id = user.id
+    tcategory_ids = [row.id for row in Tcategory.query.filter_by(user_id=user_id).all()]
+
+    def add_transactions(tcategory_ids, count):
+        for i in range(count):
+            db.session.add(Transaction(date=datetime.now() - timedelta(days=i % 60), user_id=user_id,
+                                       tcategory_id=tcategory_ids[i % len(tcategory_ids)], amount=i,
+                                       details=f'check {i}'))
+        db.session.commit()
+
+    def query_counts():
+        db.session.remove()
+        # both runs start with cold user, reference data and category caches
+        invalidate_user(user_id)
+        invalidate_reference_data()
+        invalidate_user_tcategories(user_id)
+        client = current_app.test_client()
+        client.post('/login', data={'email': 'check@budgy.tld', 'password': 'password'})
+        counts = {}
+        for url in urls:
+            db.session.remove()
+            counts[url] = int(client.get(url).headers['X-Query-Count'])
+        return counts
+
+    # one receipt and one expenditure (default categories are ordered by transaction type)
+    add_transactions([tcategory_ids[0], tcategory_ids[-1]], 2)
+    transaction_id = Transaction.query.filter_by(user_id=user_id).first().id
+    urls = ['/chart_actual_month/1', '/chart_actual_month/2', '/transaction_overview/', '/transaction_overview/1',
+            '/transaction_overview/2', f'/transaction_view/{transaction_id}', f'/transaction_edit/{transaction_id}',
+            '/category_overview']
+    few = query_counts()
+    add_transactions(tcategory_ids, 20 * len(tcategory_ids))
+    many = query_counts()
+    failed = False
+    for url in few:
+        failed = failed or few[url] != many[url]
+        print(f"{url}: {few[url]} -> {many[url]} queries {'ok' if few[url] == many[url] else 'GROWS WITH ROWS'}")
+    if failed:
+        sys.exit(1)
+
+
+@manager.option('-n', '--rows', dest='rows', type=int, default=95)
+# verify that "Next page" of the admin log pages through all rows once, incl. rows in the sqlite CURRENT_TIMESTAMP
+# format without microseconds (written in the same second, ties) next to rows of the background log writer
+# (runs against a temporary sqlite database)
+def check_admin_log_pages(rows):
+    app = create_app(dict(MIGRATE=False, SECRET_KEY=current_app.config['SECRET_KEY'] or 'check',
+                          SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(tempfile.mkdtemp(), 'check.db'),
+                          WTF_CSRF_ENABLED=False, ULOG_ASYNC=False))
+    with app.app_context():
+        db.create_all()
+        init_db()
+        # every second row of the admin user (user filter)
+        entries = [dict(action_id=5, user_id=1 if i % 2 else None, details=f'check-{i}') for i in range(rows)]
+        # first half: server default (CURRENT_TIMESTAMP), second half: timestamps of the background writer
+        for entry in entries[rows // 2:]:
+            entry['timestamp'] = datetime.utcnow()
+        table = Ulog.__table__
+        db.session.execute(table.insert(), entries[:rows // 2])
+        db.session.execute(table.insert(), entries[rows // 2:])
+        db.session.commit()
+        db.session.remove()
+    newest_first = [entry['details'] for entry in reversed(entries)]
+    client = app.test_client()
+    client.post('/login', data={'email': 'admin@budgy.tld', 'password': 'password'})
+    failed = False
+    for name, url, expected in (('all rows', '/admin/', newest_first),
+                                ('user filter', '/admin/?search=1', newest_first[rows % 2::2])):
+        shown = []
+        while url and len(shown) <= rows:
+            page = client.get(url).get_data(as_text=True)
+            shown += re.findall(r'check-\d+', page)
+            url = html.unescape(next(iter(re.findall(r'href="([^"]+)">Next page', page)), '')) or None
+        ok = shown == expected
+        failed = failed or not ok
+        print(f"{name}: {len(shown)} of {len(expected)} rows shown {'ok' if ok else 'ROWS MISSING OR REPEATED'}")
+    if failed:
+        sys.exit(1)
+
+
+@manager.command
+# verify that invalid input is rejected with a message instead of a server error (transaction form, csv import
+# with invalid amounts and short rows)
+# (runs against a temporary sqlite database)
+def check_invalid_input():
+    app = create_app(dict(ADMIN=False, MIGRATE=False, SECRET_KEY=current_app.config['SECRET_KEY'] or 'check',
+                          SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(tempfile.mkdtemp(), 'check.db'),
+                          WTF_CSRF_ENABLED=False))
+    with app.app_context():
+        db.create_all()
+        init_db()
+        tcategory_id = Tcategory.query.filter_by(user_id=1, name='Food').first().id
+        db.session.remove()
+    client = app.test_client()
+    client.post('/login', data={'email': 'admin@budgy.tld', 'password': 'password'})
+    failed = False
+    for amount in ('NaN', 'Infinity', '1e30', '-2000000'):
+        response = client.post('/transaction_add/2', data={'tcategory': tcategory_id, 'date': '2018-01-01',
+                                                            'amount': amount, 'details': 'invalid'})
+        # the form is shown again with the error
+        ok = response.status_code == 200
+        failed = failed or not ok
+        print(f"transaction_add amount {amount}: {response.status_code} {'ok' if ok else 'NOT REJECTED'}")
+    # cached pages with query arguments (None url defaults and query strings in the cache key), the second request
+    # goes through the cache
+    for url in ('/chart_actual_month/?ttype_id=2', '/chart_actual_month/2?ttype_id=1&x=', '/transaction_overview/?a=1'):
+        codes = [client.get(url).status_code for _ in range(2)]
+        ok = codes == [200, 200]
+        failed = failed or not ok
+        print(f"{url}: {codes} {'ok' if ok else 'FAILED'}")
+    # analytics ranges: one period per month / quarter, longer ranges than MAX_ANALYTICS_MONTHS are rejected
+    for url, expected in (('/api/analytics/month/?start=2017-11&end=2018-02', 4),
+                          ('/api/analytics/quarter/2?start=2017-11&end=2018-02', 2),
+                          ('/api/analytics/year/?start=1970-01&end=2019-12', 50),
+                          ('/api/analytics/month/?start=0001-01&end=9999-12', None),
+                          ('/api/analytics/year/?start=1970-01&end=2020-01', None)):
+        response = client.get(url)
+        periods = len(json.loads(response.get_data(as_text=True))['xAxis']['categories']) \
+            if response.status_code == 200 else None
+        ok = response.status_code == (200 if expected else 400) and periods == expected
+        failed = failed or not ok
+        print(f"{url}: {response.status_code} {periods} periods {'ok' if ok else 'FAILED'}")
+    lines = ['date,type,category,amount,details', '2018-01-01,Expenditures,Food,1e30,invalid',
+             '2018-01-01,Expenditures,Food,NaN,invalid', '2018-01-01,Expenditures,Food,12.50,valid',
+             # short rows (no amount / only a date)
+             '2018-01-01,Expenditures,Food', '2018-01-01']
+    response = client.post('/transaction_import', data={'file': (io.BytesIO('\n'.join(lines).encode()), 'import.csv')})
+    with app.app_context():
+        details = [row.details for row in Transaction.query.filter_by(user_id=1)]
+        db.session.remove()
+    ok = response.status_code == 302 and details == ['valid']
+    failed = failed or not ok
+    print(f"transaction_import: {response.status_code}, imported {details} {'ok' if ok else 'FAILED'}")
+    # latin-1 upload, the invalid byte comes after more than one chunk (1000 rows) of valid rows
+    lines = ['date,type,category,amount,details'] + ['2018-01-01,Expenditures,Food,1.00,chunk'] * 1500 + \
+        ['2018-01-01,Expenditures,Food,1.00,Caf\xe9']
+    response = client.post('/transaction_import',
+                           data={'file': (io.BytesIO('\n'.join(lines).encode('latin-1')), 'import.csv')})
+    with app.app_context():
+        count = Transaction.query.filter_by(user_id=1).count()
+        db.session.remove()
+    ok = response.status_code == 200 and b'not UTF-8 encoded' in response.data and count == 1
+    failed = failed or not ok
+    print(f"transaction_import latin-1: {response.status_code}, {count - 1} imported {'ok' if ok else 'FAILED'}")
+    if failed:
+        sys.exit(1)
+
+
+@manager.option('-u', '--user', dest='email', required=True)
+@manager.option('-f', '--format', dest='fmt', default='csv', choices=list(EXPORT_FORMATS))
+@manager.option('-s', '--start', dest='start', help='YYYY-MM-DD (inclusive)')
+@manager.option('-e', '--end', dest='end', help='YYYY-MM-DD (exclusive)')
+@manager.option('-o', '--output', dest='output', help='file (default: stdout)')
+# export the transactions of a user as csv / ndjson (streamed, constant memory)
+def export_transactions(email, fmt, start, end, output):
+    user = User.query.filter_by(email=email).first()
+    if user is None:
+        sys.exit(f'unknown user {email}')
+    rows = export_rows(user.id, parse_date(start) if start else None, parse_date(end) if end else None)
+    out = open(output, 'w', newline='') if output else sys.stdout
+    try:
+        for chunk in EXPORT_FORMATS[fmt][0](rows):
+            out.write(chunk)
+    finally:
+        if output:
+            out.close()
+
+
+@manager.option('-u', '--user', dest='email', required=True)
+@manager.option('-i', '--input', dest='input', required=True, help='csv file (columns as in the export)')
+# bulk import of transactions from a csv file
+def import_csv(email, input):
+    user = User.query.filter_by(email=email).first()
+    if user is None:
+        sys.exit(f'unknown user {email}')
+    with open(input, newline='', encoding='utf-8-sig') as lines:
+        try:
+            imported, errors = import_transactions(user.id, lines)
+        except ValueError as e:
+            sys.exit(f'{input}: {e}, nothing imported')
+    for line_number, error in errors:
+        print(f'line {line_number} skipped: {error}')
+    print(f'{imported} transactions imported')
+
+
+@manager.option('-r', '--rows', dest='rows', type=int, default=100000)
+# import benchmark (runs against a temporary sqlite database)
+def bench_import(rows):
+    directory = tempfile.mkdtemp()
+    current_app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'bench.db')
+    current_app.config['ULOG_ASYNC'] = False
+    db.create_all()
+    init_db()
+    categories = Tcategory.query.filter_by(user_id=1).all()
+    path = os.path.join(directory, 'import.csv')
+    with open(path, 'w', newline='') as out:
+        writer = csv.writer(out)
+        writer.writerow(EXPORT_COLUMNS)
+        for i in range(rows):
+            category = categories[i % len(categories)]
+            writer.writerow([None, (datetime(2018, 1, 1) + timedelta(minutes=i)).strftime('%Y-%m-%d %H:%M:%S'),
+                             category.ttype.name, category.name, i % 500 + 0.5, f'bench {i}', None, None, None])
+    start = time.perf_counter()
+    with open(path, newline='') as lines:
+        imported, errors = import_transactions(1, lines)
+    seconds = time.perf_counter() - start
+    totals = db.session.query(func.sum(MonthlyCategoryTotal.count)).scalar()
+    print(f"{imported} rows imported in {seconds:.2f} s ({imported / seconds:.0f} rows/s), {len(errors)} errors, "
+          f"{totals} rows in the monthly totals")
+
+
+# insert users (core inserts, default categories copied for all users at once), returns their ids
+# exits if one of the emails exists already, the caller commits
+def create_users(emails, password_hashes, level):
+    table = User.__table__
+    connection = db.session.connection()
+    for i in range(0, len(emails), 500):
+        existing = connection.execute(select([table.c.email]).where(table.c.email.in_(emails[i:i + 500]))).fetchall()
+        if existing:
+            sys.exit(f'users already exist: {", ".join(row.email for row in existing[:10])}')
+    # core inserts bypass the user after_insert listener
+    connection.execute(table.insert(), [dict(email=address, password_hash=password_hash, level=level)
+                                        for address, password_hash in zip(emails, password_hashes)])
+    user_ids = []
+    for i in range(0, len(emails), 500):
+        user_ids += [row.id for row in connection.execute(select([table.c.id])
+                                                          .where(table.c.email.in_(emails[i:i + 500])))]
+    copy_default_tcategories(connection, user_ids)
+    return user_ids
+
+
+@manager.option('-n', '--number', dest='number', type=int, required=True)
+@manager.option('-e', '--email', dest='email', default='user{}@budgy.tld', help='email pattern, {} -> 1..n')
+@manager.option('-p', '--password', dest='password', required=True, help='initial password of all users')
+@manager.option('-l', '--level', dest='level', default='user', choices=['user', 'admin'])
+# create n users (incl. their default categories) in one transaction
+def provision_users(number, email, password, level):
+    start = time.perf_counter()
+    emails = [email.format(i) for i in range(1, number + 1)]
+    user_ids = create_users(emails, password_hasher.hash_many([password] * len(emails)), level)
+    db.session.commit()
+    print(f"{len(user_ids)} users created in {time.perf_counter() - start:.2f} s")
+
+
+# n users with m transactions each over the last years (same data for the same seed and day), bulk inserts in
+# chunks of 10000 rows per db transaction incl. the monthly totals, returns the user ids
+def create_load_data(users, transactions, years, email, password, seed):
+    rng = Random(seed)
+    emails = [email.format(i) for i in range(1, users + 1)]
+    # one hash for all users, hashing is measured by bench_password_hash
+    user_ids = create_users(emails, [password_hasher.hash(password)] * len(emails), 'user')
+    db.session.commit()
+    # (id, ttype id) of the users categories, receipts / expenditures
+    categories = {user_id: ([], []) for user_id in user_ids}
+    for i in range(0, len(user_ids), 500):
+        for user_id, tcategory_id, ttype_id in db.session.query(Tcategory.user_id, Tcategory.id, Tcategory.ttype_id)\
+                .filter(Tcategory.user_id.in_(user_ids[i:i + 500])).order_by(Tcategory.id):
+            categories[user_id][ttype_id - 1].append(tcategory_id)
+    first = datetime.combine(date.today(), datetime.min.time()) - timedelta(days=365 * years)
+    minutes = 365 * years * 24 * 60
+    for user_id in user_ids:
+        receipts, expenditures = categories[user_id]
+        rows = []
+        for i in range(transactions):
+            # about one receipt per ten expenditures, amounts in cents
+            if rng.random() < 0.1:
+                tcategory_id, amount = rng.choice(receipts), Decimal(rng.randint(10000, 500000)).scaleb(-2)
+            else:
+                tcategory_id, amount = rng.choice(expenditures), -Decimal(rng.randint(100, 20000)).scaleb(-2)
+            rows.append(dict(date=first + timedelta(minutes=rng.randrange(minutes)), user_id=user_id,
+                             tcategory_id=tcategory_id, amount=amount, details=f'generated {i}'))
+            if len(rows) == 10000:
+                insert_transactions(user_id, rows)
+                rows = []
+        if rows:
+            insert_transactions(user_id, rows)
+    return user_ids
+
+
+@manager.option('-n', '--users', dest='users', type=int, default=100)
+@manager.option('-m', '--transactions', dest='transactions', type=int, default=1000, help='per user')
+@manager.option('-y', '--years', dest='years', type=int, default=3, help='transactions spread over the last years')
+@manager.option('-e', '--email', dest='email', default='load{}@budgy.tld', help='email pattern, {} -> 1..n')
+@manager.option('-p', '--password', dest='password', default='password', help='password of all users')
+@manager.option('-s', '--seed', dest='seed', type=int, default=1)
+# load test data: n users with m transactions each (same data for the same seed and day)
+def generate_data(users, transactions, years, email, password, seed):
+    start = time.perf_counter()
+    user_ids = create_load_data(users, transactions, years, email, password, seed)
+    print(f"{len(user_ids)} users with {transactions} transactions each created in "
+          f"{time.perf_counter() - start:.2f} s")
+
+
+@manager.option('-m', '--methods', dest='methods', default='pbkdf2:sha256:50000,pbkdf2:sha256:150000,'
+                                                            'pbkdf2:sha256:300000,pbkdf2:sha512:150000')
+@manager.option('-n', '--logins', dest='logins', type=int, default=20)
+# password check benchmark: logins per second and core for each hash method / cost
+# (plus the throughput of the PASSWORD_HASH_WORKERS process pool)
+def bench_password_hash(methods, logins):
+    workers = password_hasher.workers
+    for method in methods.split(','):
+        password_hasher.method = method
+        password_hash = password_hasher.hash('password')
+        results = []
+        for pool_workers in (0, workers):
+            password_hasher.workers = pool_workers
+            start = time.perf_counter()
+            if pool_workers:
+                # concurrent logins, like the request threads of a worker
+                with ThreadPoolExecutor(max_workers=pool_workers * 2) as executor:
+                    list(executor.map(lambda _: password_hasher.check(password_hash, 'password'), range(logins)))
+            else:
+                for _ in range(logins):
+                    password_hasher.check(password_hash, 'password')
+            results.append(logins / (time.perf_counter() - start))
+        print(f"{method}: {results[0]:.1f} logins/s per core, {results[1]:.1f} logins/s with {workers} pool workers")
+
+
+@manager.option('-g', '--grace', dest='grace', type=int, default=24, help='hours')
+@manager.option('-n', '--dry-run', dest='dry_run', action='store_true')
+# remove receipt files no transaction references (any more) and which are older than the grace period
+# (receipts with refcount 0 plus files without receipt row / transaction, e.g. aborted uploads)
+def cleanup_receipts(grace, dry_run):
+    cutoff = datetime.utcnow() - timedelta(hours=grace)
+    root = current_app.config['UPLOADED_RECEIPTS_DEST']
+    table = Receipt.__table__
+    removed = 0
+    for receipt_id, name in db.session.query(Receipt.id, Receipt.name)\
+                                      .filter(Receipt.refcount <= 0, Receipt.modified < cutoff).all():
+        if not dry_run:
+            # the row is only deleted if the file has not been referenced again in the meantime
+            if db.session.execute(table.delete().where((table.c.id == receipt_id) & (table.c.refcount <= 0)))\
+                    .rowcount == 0:
+                continue
+            db.session.commit()
+        path = os.path.join(root, name)
+        if os.path.exists(path):
+            print(f'remove {name}')
+            if not dry_run:
+                os.remove(path)
+                for variant in current_app.config['RECEIPT_PREVIEW_SIZES']:
+                    if os.path.exists(variant_name(path, variant)):
+                        os.remove(variant_name(path, variant))
+            removed += 1
+
+    # files without receipt row and transaction
+    known = set(name for name, in db.session.query(Receipt.name))
+    known.update(name for name, in db.session.query(Transaction.attachment_name).distinct())
+    file_cutoff = time.time() - grace * 3600
+    for directory in (os.listdir(root) if os.path.isdir(root) else []):
+        if not os.path.isdir(os.path.join(root, directory)):
+            continue
+        for filename in os.listdir(os.path.join(root, directory)):
+            path = os.path.join(root, directory, filename)
+            # previews belong to their original
+            original = re.sub(r'\.\w+\.jpg$', '', filename) if filename.endswith('.jpg') else filename
+            if f'{directory}/{filename}' not in known and f'{directory}/{original}' not in known and \
+                    os.path.getmtime(path) < file_cutoff:
+                print(f'remove {directory}/{filename} (unreferenced)')
+                if not dry_run:
+                    os.remove(path)
+                removed += 1
+    print(f"{removed} files {'to remove' if dry_run else 'removed'}")
+
+
+@manager.option('-g', '--grace', dest='grace', type=int, default=30, help='days')
+@manager.option('-n', '--dry-run', dest='dry_run', action='store_true')
+@manager.option('-c', '--chunk-size', dest='chunk_size', type=int, default=1000)
+# hard delete categories soft deleted more than grace days ago which no transaction references (any more),
+# chunk_size rows per db transaction
+def purge_tcategories(grace, dry_run, chunk_size):
+    cutoff = datetime.utcnow() - timedelta(days=grace)
+    table = Tcategory.__table__
+    rollup = MonthlyCategoryTotal.__table__
+    unreferenced = and_(table.c.deleted.isnot(None), table.c.deleted < cutoff,
+                        ~exists().where(Transaction.__table__.c.tcategory_id == table.c.id),
+                        ~exists().where(rollup.c.tcategory_id == table.c.id))
+    if dry_run:
+        purged = db.session.execute(select([func.count()]).where(unreferenced)).scalar()
+    else:
+        purged = 0
+        while True:
+            chunk = select([table.c.id]).where(unreferenced).limit(chunk_size)
+            count = db.session.execute(table.delete().where(table.c.id.in_(chunk))).rowcount
+            db.session.commit()
+            purged += count
+            if count < chunk_size:
+                break
+    print(f"{purged} deleted categories {'to purge' if dry_run else 'purged'}")
+
+
+@manager.option('-u', '--user', dest='email', required=True)
+# delete a user incl. all data and receipts (chunked, see helpers.delete_user)
+def delete_user(email):
+    user = User.query.filter_by(email=email).first()
+    if user is None:
+        sys.exit(f'unknown user {email}')
+    job = Job(f'delete user {email}')
+    user_id = user.id
+    db.session.remove()
+    delete_user_data(job, user_id, current_app.config['USER_DELETE_CHUNK_SIZE'])
+    print(job.progress)
+
+
+@manager.command
+# create missing previews of existing receipt images (new uploads are handled by the background workers)
+def generate_previews():
+    root = current_app.config['UPLOADED_RECEIPTS_DEST']
+    names = set(name for name, in db.session.query(Receipt.name).filter(Receipt.refcount > 0))
+    names.update(name for name, in db.session.query(Transaction.attachment_name).distinct() if name)
+    created = 0
+    for name in sorted(names):
+        if is_image(name) and os.path.exists(os.path.join(root, name)):
+            try:
+                make_previews(os.path.join(root, name), current_app.config['RECEIPT_PREVIEW_SIZES'],
+                              current_app.config['RECEIPT_PREVIEW_QUALITY'])
+                created += 1
+            except Exception as e:
+                print(f'{name}: {e}')
+    print(f"previews of {created} images checked / created")
+
+
+# export in a fresh interpreter, prints seconds, peak rss before and after the export (KiB)
+# (VmHWM on linux, ru_maxrss would include the peak of the parent process)
+EXPORT_SCRIPT = '''
+import resource, sys, time
+from application import create_app
+from helpers import export_rows, EXPORT_FORMATS
+
+def peak_rss():
+    try:
+        with open('/proc/self/status') as status:
+            return next(int(line.split()[1]) for line in status if line.startswith('VmHWM'))
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+app = create_app(dict(ADMIN=False, MIGRATE=False, SQLALCHEMY_DATABASE_URI=sys.argv[1]))
+with app.app_context():
+    rss = peak_rss()
+    start = time.perf_counter()
+    with open(sys.argv[3], 'w') as out:
+        for chunk in EXPORT_FORMATS[sys.argv[2]][0](export_rows(1)):
+            out.write(chunk)
+    print(time.perf_counter() - start, rss, peak_rss())
+'''
+
+
+@manager.option('-r', '--rows', dest='sizes', default='1000,10000,100000,1000000', help='comma separated row counts')
+@manager.option('-f', '--format', dest='fmt', default='csv', choices=list(EXPORT_FORMATS))
+# export benchmark: peak memory of the export has to stay flat with a growing number of rows
+# (runs against a temporary sqlite database, rows are inserted without the rollup listeners)
+def bench_export(sizes, fmt):
+    directory = tempfile.mkdtemp()
+    uri = 'sqlite:///' + os.path.join(directory, 'bench.db')
+    current_app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    db.create_all()
+    init_db()
+    tcategory_ids = [row.id for row in Tcategory.query.filter_by(user_id=1).all()]
+    table = Transaction.__table__
+    count = 0
+    for size in sorted(int(value) for value in sizes.split(',')):
+        while count < size:
+            chunk = range(count, min(size, count + 10000))
+            db.session.execute(table.insert(), [dict(date=datetime(2018, 1, 1) + timedelta(minutes=i), user_id=1,
+                                                     tcategory_id=tcategory_ids[i % len(tcategory_ids)], amount=i,
+                                                     details=f'bench {i}') for i in chunk])
+            count += len(chunk)
+        db.session.commit()
+        output = subprocess.check_output([sys.executable, '-c', EXPORT_SCRIPT, uri, fmt,
+                                          os.path.join(directory, 'export.' + fmt)],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        seconds, rss_before, rss_after = [float(value) for value in output.split()]
+        print(f"{size} rows: {seconds:.2f} s, {size / seconds:.0f} rows/s, "
+              f"peak rss {rss_after / 1024:.1f} MiB (+{(rss_after - rss_before) / 1024:.1f} MiB during the export)")
+    # sqlite keeps up to SQLITE_CACHE_SIZE KiB of pages per connection, the growth levels off there
+    print(f"sqlite page cache limit: {current_app.config['SQLITE_CACHE_SIZE'] / 1024:.1f} MiB")
+
+
+# measured in a fresh interpreter: import, create_app (web / cli config) and the first request
+STARTUP_SCRIPT = '''
+import os, time
+start = time.perf_counter()
+from application import create_app
+imported = time.perf_counter()
+app = create_app(dict(SECRET_KEY=os.environ.get('SECRET_KEY', 'startup')))
+created = time.perf_counter()
+create_app(dict(ADMIN=False, MIGRATE=False))
+created_cli = time.perf_counter()
+app.test_client().get('/login')
+print(imported - start, created - imported, created_cli - created, time.perf_counter() - created_cli)
+'''
+
+
+@manager.option('-n', '--runs', dest='runs', type=int, default=5)
+# startup time benchmark (cost paid by every worker, CLI run and test)
+def bench_startup(runs):
+    results = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        results.append([float(value) for value in output.split()])
+    for i, name in enumerate(('import', 'create_app', 'create_app (cli)', 'first request')):
+        values = sorted(result[i] for result in results)
+        print(f"{name}: median {values[len(values) // 2] * 1000:.0f} ms, min {values[0] * 1000:.0f} ms")
+
+
+# routes of bench_routes: name -> (method, path, form data) of the i-th request of a user
+BENCH_ROUTES = {
+    'login': lambda user, i: ('POST', '/login', {'email': user['email'], 'password': 'password'}),
+    'chart_actual_month': lambda user, i: ('GET', '/chart_actual_month/', None),
+    'transaction_overview': lambda user, i: ('GET', '/transaction_overview/', None),
+    'transaction_add': lambda user, i: ('POST', '/transaction_add/2', {
+        'tcategory': user['tcategory_id'], 'date': date.today().isoformat(), 'amount': f'{i % 200 + 1}.25',
+        'details': f'bench {i}'}),
+    'send_img': lambda user, i: ('GET', user['receipt'], None),
+}
+
+
+# http client with a cookie jar for the local load mode of bench_routes (redirects are not followed)
+class BenchHttpClient(object):
+    def __init__(self, port):
+        self.connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        self.cookies = SimpleCookie()
+
+    # returns status, X-Query-Count
+    def request(self, method, path, data=None):
+        headers = {}
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f'{name}={morsel.value}' for name, morsel in self.cookies.items())
+        body = None
+        if data is not None:
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        self.connection.request(method, path, body, headers)
+        response = self.connection.getresponse()
+        response.read()
+        for header in response.msg.get_all('Set-Cookie') or []:
+            self.cookies.load(header)
+        return response.status, int(response.getheader('X-Query-Count', 0))
+
+
+# local http server of bench_routes without access log
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args):
+        pass
+
+
+# nearest rank percentile of sorted values
+def percentile(values, p):
+    return values[max(0, math.ceil(p * len(values) / 100) - 1)]
+
+
+@manager.option('-n', '--users', dest='users', type=int, default=10)
+@manager.option('-m', '--transactions', dest='transactions', type=int, default=5000, help='per user')
+@manager.option('-r', '--requests', dest='requests', type=int, default=200, help='per route and mode')
+@manager.option('-w', '--warmup', dest='warmup', type=int, default=10, help='unmeasured requests per route')
+@manager.option('-c', '--concurrency', dest='concurrency', type=int, default=0,
+                help='threads of the local http load mode (0: test client only)')
+@manager.option('-s', '--seed', dest='seed', type=int, default=1)
+@manager.option('-d', '--database', dest='database', help='empty database (default: temporary sqlite database)')
+@manager.option('--page-cache', dest='page_cache', action='store_true', help='measure with the page cache')
+# latency (p50 / p95 / p99), throughput and sql statements per request of the core routes against generated data
+# (see generate_data, same data for the same seed): sequentially through the test client and, with -c, by
+# concurrent clients against a local threaded http server. Rendered pages are uncached unless --page-cache is given.
+def bench_routes(users, transactions, requests, warmup, concurrency, seed, database, page_cache):
+    # Pillow is only needed for the receipt uploads
+    from PIL import Image
+    directory = tempfile.mkdtemp()
+    app = create_app(dict(ADMIN=False, MIGRATE=False, SECRET_KEY=current_app.config['SECRET_KEY'] or 'bench',
+                          SQLALCHEMY_DATABASE_URI=database or 'sqlite:///' + os.path.join(directory, 'bench.db'),
+                          WTF_CSRF_ENABLED=False, QUERY_COUNT=True, PAGE_CACHE=page_cache, RECEIPT_PREVIEW_SIZES={},
+                          UPLOADED_RECEIPTS_DEST=os.path.join(directory, 'Receipts/')))
+    with app.app_context():
+        db.create_all()
+        init_db()
+        user_ids = create_load_data(users, transactions, 3, 'load{}@budgy.tld', 'password', seed)
+        expenditures = dict(db.session.query(Tcategory.user_id, func.min(Tcategory.id))
+                            .filter(Tcategory.user_id.in_(user_ids), Tcategory.ttype_id == 2)
+                            .group_by(Tcategory.user_id))
+        db.session.remove()
+    # one receipt per user (uploaded like by the app), requests run outside of the app context like in production
+    image = io.BytesIO()
+    Image.new('RGB', (1200, 1600), (240, 240, 230)).save(image, 'JPEG', quality=85)
+    bench_users = []
+    for number, user_id in enumerate(user_ids, 1):
+        user = dict(id=user_id, email=f'load{number}@budgy.tld', tcategory_id=expenditures[user_id],
+                    client=app.test_client())
+        user['client'].post('/login', data={'email': user['email'], 'password': 'password'})
+        user['client'].post('/transaction_add/2', data=dict(BENCH_ROUTES['transaction_add'](user, 0)[2],
+                                                            attachment=(io.BytesIO(image.getvalue()), 'receipt.jpg')))
+        bench_users.append(user)
+    with app.app_context():
+        for user in bench_users:
+            user['receipt'] = '/static/uploads/Receipts/' + db.session.query(Transaction.attachment_name)\
+                .filter(Transaction.user_id == user['id'], Transaction.attachment_name.isnot(None)).limit(1).scalar()
+        db.session.remove()
+
+    def test_client_requests(route, count):
+        results = []
+        for i in range(count):
+            user = bench_users[i % len(bench_users)]
+            # logins need a client without session (logged in users are redirected)
+            client = app.test_client() if route == 'login' else user['client']
+            method, path, data = BENCH_ROUTES[route](user, i)
+            start = time.perf_counter()
+            response = client.open(path, method=method, data=data, buffered=True)
+            results.append((time.perf_counter() - start, response.status_code,
+                            int(response.headers.get('X-Query-Count', 0))))
+        return results
+
+    def http_requests(route, count):
+        clients = []
+        for thread in range(concurrency):
+            user = bench_users[thread % len(bench_users)]
+            client = BenchHttpClient(server.server_port)
+            client.request(*BENCH_ROUTES['login'](user, 0))
+            clients.append((user, client))
+        numbers = itertools.count()
+        results = []
+
+        def worker(thread):
+            user, client = clients[thread]
+            # next() of itertools.count is atomic
+            for i in numbers:
+                if i >= count:
+                    break
+                if route == 'login':
+                    client = BenchHttpClient(server.server_port)
+                method, path, data = BENCH_ROUTES[route](user, i)
+                start = time.perf_counter()
+                status, queries = client.request(method, path, data)
+                results.append((time.perf_counter() - start, status, queries))
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(worker, range(concurrency)))
+        return results
+
+    modes = [('test client', test_client_requests)]
+    if concurrency:
+        server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietRequestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        modes.append((f'http x{concurrency}', http_requests))
+    print(f"{'mode':<12} {'route':<21} {'requests':>8} {'errors':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'req/s':>8} {'queries':>7}")
+    for mode, run in modes:
+        for route in BENCH_ROUTES:
+            run(route, warmup)
+            start = time.perf_counter()
+            results = run(route, requests)
+            seconds = time.perf_counter() - start
+            latencies = sorted(result[0] * 1000 for result in results)
+            errors = sum(1 for result in results if result[1] >= 400)
+            queries = sum(result[2] for result in results) / len(results)
+            print(f"{mode:<12} {route:<21} {len(results):>8} {errors:>6} {percentile(latencies, 50):>8.1f} "
+                  f"{percentile(latencies, 95):>8.1f} {percentile(latencies, 99):>8.1f} "
+                  f"{len(results) / seconds:>8.1f} {queries:>7.1f}")
+    if concurrency:
+        server.shutdown()
+
+
 if __name__ == "__main__":
     manager.run()
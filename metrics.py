@@ -0,0 +1,230 @@
+import logging
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter, deque
+from functools import partial
+from flask import request
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.wsgi import ClosingIterator
+
+from workers import PerProcess, start_thread
+
+logger = logging.getLogger(__name__)
+
+# upper bounds (seconds) of the request latency histogram
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# stats of the request handled by the current thread (set by Instrumentation)
+local = threading.local()
+
+
+# Counters of one request
+class RequestStats(object):
+    __slots__ = ('method', 'path', 'endpoint', 'sql_count', 'sql_time', 'template_time', 'samples')
+
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        self.endpoint = 'unmatched'
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.samples = None
+
+
+def current_stats():
+    return getattr(local, 'stats', None)
+
+
+# Totals of one endpoint, bucket counts are not cumulative (summed up by Metrics.render)
+class EndpointMetrics(object):
+    __slots__ = ('buckets', 'count', 'duration', 'sql_count', 'sql_time', 'template_time')
+
+    def __init__(self, buckets):
+        self.buckets = [0] * (buckets + 1)
+        self.count = 0
+        self.duration = 0.0
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+
+
+# Per endpoint latency histograms, sql statement counts / time and template render time of this worker process
+# (each worker exports its own numbers, prometheus sums them up)
+class Metrics(object):
+    def __init__(self, buckets=LATENCY_BUCKETS, prefix='budgy'):
+        self.buckets = buckets
+        self.prefix = prefix
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def observe(self, stats, duration):
+        with self.lock:
+            entry = self.endpoints.get(stats.endpoint)
+            if entry is None:
+                entry = self.endpoints[stats.endpoint] = EndpointMetrics(len(self.buckets))
+            entry.buckets[bisect_left(self.buckets, duration)] += 1
+            entry.count += 1
+            entry.duration += duration
+            entry.sql_count += stats.sql_count
+            entry.sql_time += stats.sql_time
+            entry.template_time += stats.template_time
+
+    # prometheus text exposition format
+    def render(self):
+        with self.lock:
+            endpoints = [(name, list(entry.buckets), entry.count, entry.duration, entry.sql_count, entry.sql_time,
+                          entry.template_time) for name, entry in sorted(self.endpoints.items())]
+        name = f'{self.prefix}_request_duration_seconds'
+        lines = [f'# HELP {name} Request latency per endpoint (until the response is sent)',
+                 f'# TYPE {name} histogram']
+        for endpoint, buckets, count, duration, _, _, _ in endpoints:
+            label = f'endpoint="{escape_label(endpoint)}"'
+            total = 0
+            for bound, bucket in zip(self.buckets + ('+Inf',), buckets):
+                total += bucket
+                lines.append(f'{name}_bucket{{{label},le="{bound}"}} {total}')
+            lines.append(f'{name}_sum{{{label}}} {duration}')
+            lines.append(f'{name}_count{{{label}}} {count}')
+        counters = (('sql_statements_total', 'SQL statements executed per endpoint', 4),
+                    ('sql_duration_seconds_total', 'Time spent in SQL statements per endpoint', 5),
+                    ('template_render_seconds_total', 'Time spent rendering templates per endpoint', 6))
+        for suffix, description, index in counters:
+            name = f'{self.prefix}_{suffix}'
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} counter']
+            lines += [f'{name}{{endpoint="{escape_label(row[0])}"}} {row[index]}' for row in endpoints]
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Sampling profiler: a daemon thread records the stack of every running request each interval seconds,
+# requests slower than threshold seconds log their most frequent stacks (the last keep reports are kept)
+class SamplingProfiler(object):
+    def __init__(self, threshold=None, interval=0.005, top=5, depth=40, keep=20):
+        self.threshold = threshold
+        self.interval = interval
+        self.top = top
+        self.depth = depth
+        self.active = {}
+        self.reports = deque(maxlen=keep)
+        # held while samples are recorded, requests are only removed from active under it
+        self.sampling = threading.Lock()
+        self.sampler = PerProcess(lambda: start_thread(self.run, 'sampling-profiler'))
+
+    def start(self):
+        self.sampler.get()
+
+    def begin(self, stats):
+        if not self.threshold:
+            return
+        self.start()
+        stats.samples = Counter()
+        with self.sampling:
+            self.active[threading.get_ident()] = stats
+
+    def end(self, stats, duration):
+        with self.sampling:
+            if self.active.pop(threading.get_ident(), None) is None:
+                return
+        if duration < self.threshold or not stats.samples:
+            return
+        report = self.report(stats, duration)
+        self.reports.appendleft(report)
+        logger.warning(report)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.sampling:
+                for thread_id, stats in self.active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stats.samples[self.stack(frame)] += 1
+
+    # innermost depth frames, outermost first
+    def stack(self, frame):
+        entries = []
+        while frame is not None and len(entries) < self.depth:
+            entries.append(f'{frame.f_code.co_filename}:{frame.f_lineno} {frame.f_code.co_name}')
+            frame = frame.f_back
+        return tuple(reversed(entries))
+
+    def report(self, stats, duration):
+        total = sum(stats.samples.values())
+        lines = [f'slow request {stats.method} {stats.path} ({stats.endpoint}): {duration:.3f} s, '
+                 f'{stats.sql_count} sql statements in {stats.sql_time:.3f} s, {total} samples']
+        for stack, count in stats.samples.most_common(self.top):
+            lines.append(f'  {count} samples ({count * 100 / total:.0f}%):')
+            lines += [f'    {entry}' for entry in stack]
+        return '\n'.join(lines)
+
+
+# WSGI middleware: times the whole request (incl. streamed responses) and feeds metrics / profiler
+class Instrumentation(object):
+    def __init__(self, app, metrics, profiler=None):
+        self.app = app
+        self.metrics = metrics
+        self.profiler = profiler
+
+    def __call__(self, environ, start_response):
+        stats = local.stats = RequestStats(environ.get('REQUEST_METHOD'), environ.get('PATH_INFO'))
+        if self.profiler:
+            self.profiler.begin(stats)
+        start = time.perf_counter()
+        try:
+            response = self.app(environ, start_response)
+        except Exception:
+            self.finish(stats, start)
+            raise
+        return ClosingIterator(response, partial(self.finish, stats, start))
+
+    def finish(self, stats, start):
+        duration = time.perf_counter() - start
+        local.stats = None
+        if self.profiler:
+            self.profiler.end(stats, duration)
+        self.metrics.observe(stats, duration)
+
+
+# before_request hook: label the request with its endpoint
+def record_endpoint():
+    stats = current_stats()
+    if stats is not None:
+        stats.endpoint = request.endpoint or 'unmatched'
+
+
+# Jinja template class measuring the render time (flask renders through Template.render)
+class TimedTemplate(Template):
+    def render(self, *args, **kwargs):
+        stats = current_stats()
+        if stats is None:
+            return super(TimedTemplate, self).render(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return super(TimedTemplate, self).render(*args, **kwargs)
+        finally:
+            stats.template_time += time.perf_counter() - start
+
+
+# sql statement count and time of instrumented requests
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    if current_stats() is not None:
+        conn.info.setdefault('statement_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_statement(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats()
+    starts = conn.info.get('statement_start')
+    if stats is not None and starts:
+        stats.sql_count += 1
+        stats.sql_time += time.perf_counter() - starts.pop()
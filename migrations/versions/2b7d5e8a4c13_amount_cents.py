@@ -0,0 +1,74 @@
+"""amounts as integer cents
+
+Revision ID: 2b7d5e8a4c13
+Revises: 9e4c7a2f1b58
+Create Date: 2026-10-18 19:14:05.381942
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2b7d5e8a4c13'
+down_revision = '9e4c7a2f1b58'
+branch_labels = None
+depends_on = None
+
+# transactions converted per UPDATE (id ranges), keeps statements and locks short on large tables
+BACKFILL_CHUNK_SIZE = 10000
+
+transaction = sa.table('transaction', sa.column('id', sa.Integer), sa.column('user_id', sa.Integer),
+                       sa.column('tcategory_id', sa.Integer), sa.column('date', sa.DateTime),
+                       sa.column('amount', sa.Float), sa.column('amount_cents', sa.Integer))
+monthly_category_total = sa.table('monthly_category_total', sa.column('user_id', sa.Integer),
+                                  sa.column('year', sa.Integer), sa.column('month', sa.Integer),
+                                  sa.column('tcategory_id', sa.Integer), sa.column('total', sa.Float),
+                                  sa.column('total_cents', sa.BigInteger), sa.column('count', sa.Integer))
+
+
+# copy source into target for all transactions, one UPDATE per id range
+def backfill(source, target, value):
+    connection = op.get_bind()
+    max_id = connection.execute(sa.select([sa.func.max(transaction.c.id)])).scalar() or 0
+    for start in range(0, max_id + 1, BACKFILL_CHUNK_SIZE):
+        connection.execute(transaction.update()
+                           .where(sa.and_(transaction.c.id >= start, transaction.c.id < start + BACKFILL_CHUNK_SIZE,
+                                          transaction.c[source].isnot(None)))
+                           .values({target: value}))
+
+
+def upgrade():
+    op.add_column('transaction', sa.Column('amount_cents', sa.Integer(), nullable=True))
+    # the totals are sums of any number of amounts, 64 bit
+    op.add_column('monthly_category_total', sa.Column('total_cents', sa.BigInteger(), nullable=False,
+                                                      server_default='0'))
+    backfill('amount', 'amount_cents', sa.cast(sa.func.round(transaction.c.amount * 100), sa.Integer))
+
+    # rebuild the rollup from the exact amounts (the float totals carry rounding errors)
+    op.execute(monthly_category_total.delete())
+    year = sa.extract('year', transaction.c.date)
+    month = sa.extract('month', transaction.c.date)
+    totals = sa.select([transaction.c.user_id, year, month, transaction.c.tcategory_id,
+                        sa.func.coalesce(sa.func.sum(transaction.c.amount_cents), 0), sa.func.count(transaction.c.id),
+                        sa.literal(0.0)])\
+        .group_by(transaction.c.user_id, year, month, transaction.c.tcategory_id)
+    op.execute(monthly_category_total.insert().from_select(['user_id', 'year', 'month', 'tcategory_id', 'total_cents',
+                                                            'count', 'total'], totals))
+
+    with op.batch_alter_table('monthly_category_total') as batch_op:
+        batch_op.drop_column('total')
+    with op.batch_alter_table('transaction') as batch_op:
+        batch_op.drop_column('amount')
+
+
+def downgrade():
+    op.add_column('transaction', sa.Column('amount', sa.Float(), nullable=True))
+    op.add_column('monthly_category_total', sa.Column('total', sa.Float(), nullable=False, server_default='0'))
+    backfill('amount_cents', 'amount', transaction.c.amount_cents / 100.0)
+    op.execute(monthly_category_total.update().values(total=monthly_category_total.c.total_cents / 100.0))
+
+    with op.batch_alter_table('monthly_category_total') as batch_op:
+        batch_op.drop_column('total_cents')
+    with op.batch_alter_table('transaction') as batch_op:
+        batch_op.drop_column('amount_cents')
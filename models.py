@@ -1,13 +1,81 @@
-from application import db
-from sqlalchemy import func
-from werkzeug.security import generate_password_hash, check_password_hash
+import shutil
+from collections import namedtuple
+from decimal import Decimal, ROUND_HALF_UP
+from flask import current_app
+from sqlalchemy import func, event, and_, select, text, type_coerce
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.types import TypeDecorator
 from flask_login import UserMixin
-from application import login
+from extensions import db, login, user_cache, default_tcategory_cache, reference_cache, tcategory_cache, page_cache, \
+    password_hasher, background_jobs
+
+
+# largest amount of a transaction: the cents fit the 32 bit amount_cents column. Monthly totals (sums of any number of
+# transactions) are stored in a 64 bit column (BigMoney)
+MAX_AMOUNT = Decimal('1000000')
+
+
+# user input (forms, imports) is checked with amount_in_range before it is stored
+def amount_in_range(value):
+    return value.is_finite() and abs(value) <= MAX_AMOUNT
+
+
+# Money: stored as integer cents (exact sums in sql), Decimal in python
+# accepts Decimal, int, float and str values (floats via their shortest repr, 1.1 -> 110 cents)
+class Money(TypeDecorator):
+    impl = db.Integer
+    python_type = Decimal
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if not isinstance(value, Decimal):
+            value = Decimal(str(value))
+        if not value.is_finite():
+            raise ValueError(f'invalid amount {value}')
+        return int(value.scaleb(2).to_integral_value(rounding=ROUND_HALF_UP))
+
+    def process_result_value(self, value, dialect):
+        return Decimal(value).scaleb(-2) if value is not None else None
+
+
+# Money in a 64 bit integer column, for sums
+class BigMoney(Money):
+    impl = db.BigInteger
+
+
+# plain integer cents of a Money column / sum (aggregation over array('q') instead of Decimal objects)
+def cents(expression):
+    return type_coerce(expression, db.Integer)
+
+
+# Lightweight copy of the logged in user (current_user), kept in user_cache
+class UserSnapshot(UserMixin):
+    def __init__(self, id, email, level):
+        self.id = id
+        self.email = email
+        self.level = level
+
+    def __repr__(self):
+        return '<user {}>'.format(self.email)
 
 
 @login.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user = user_cache.get(int(user_id))
+    if user is None:
+        row = User.query.get(int(user_id))
+        if row is None:
+            return None
+        user = UserSnapshot(row.id, row.email, row.level)
+        user_cache.set(row.id, user)
+    return user
+
+
+# drop cached user after changes (other workers keep their copy until USER_CACHE_TTL expired)
+def invalidate_user(user_id):
+    user_cache.delete(user_id)
 
 
 # User related tables
@@ -19,16 +87,21 @@ class User(UserMixin, db.Model):
     lastlogin = db.Column(db.DateTime)
     tcategories = db.relationship('Tcategory', cascade="all, delete", back_populates='user')
     transactions = db.relationship('Transaction', cascade="all, delete", back_populates='user')
+    receipts = db.relationship('Receipt', cascade="all, delete", back_populates='user')
 
     def __repr__(self):
         return '<user {}>'.format(self.email)
 
-    # generate and check password hashes
+    # generate and check password hashes (see passwords.py)
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.check(self.password_hash, password)
+
+    # hash of an older method / cost setting
+    def password_needs_rehash(self):
+        return password_hasher.needs_rehash(self.password_hash)
 
 
 # User Log
@@ -39,6 +112,9 @@ class Ulog(db.Model):
     uaction = db.relationship('Uaction', backref='ulog', lazy='select')
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     details = db.Column(db.String(120))
+    # admin log view: keyset pagination by id (primary key), per user, prefix search on details
+    __table_args__ = (db.Index('ix_ulog_user_id', 'user_id', 'id'),
+                      db.Index('ix_ulog_details', 'details'))
 
 
 # User actions
@@ -65,14 +141,49 @@ class Transaction(db.Model):
     details = db.Column(db.String(500))
     attachment_name = db.Column(db.String(500))
     attachment_url = db.Column(db.String(500))
-    amount = db.Column(db.Float)
+    amount = db.Column('amount_cents', Money, key='amount')
     geo_lat = db.Column(db.Float)
     geo_lng = db.Column(db.Float)
+    # per user / per category lookups are always restricted to a date range
+    __table_args__ = (db.Index('ix_transaction_user_id_date', 'user_id', 'date'),
+                      db.Index('ix_transaction_tcategory_id_date', 'tcategory_id', 'date'))
 
     def __repr__(self):
         return '<transaction {}>'.format(self.id)
 
 
+# Monthly totals per user and category (rollup of transaction, maintained by the listeners below)
+class MonthlyCategoryTotal(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    year = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.Integer, primary_key=True)
+    tcategory_id = db.Column(db.Integer, db.ForeignKey('tcategory.id'), primary_key=True)
+    tcategory = db.relationship('Tcategory', lazy='select')
+    total = db.Column('total_cents', BigMoney, key='total', nullable=False, default=0)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<monthly_category_total {}-{} {}>'.format(self.year, self.month, self.tcategory_id)
+
+
+# Receipt files of transaction attachments, stored once per user and content (<user_id>/<sha256><ext>)
+# refcount: number of transactions referencing the file (attachment_name == name), maintained by the listeners below
+class Receipt(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user = db.relationship('User', back_populates='receipts', lazy='select')
+    # unknown for files uploaded before content addressing
+    sha256 = db.Column(db.String(64))
+    name = db.Column(db.String(500), unique=True, nullable=False)
+    size = db.Column(db.Integer)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+    modified = db.Column(db.DateTime, nullable=False, server_default=func.now())
+    __table_args__ = (db.UniqueConstraint('user_id', 'sha256', name='uq_receipt_user_id_sha256'),)
+
+    def __repr__(self):
+        return '<receipt {}>'.format(self.name)
+
+
 # Transaction categories
 class Tcategory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -83,6 +194,13 @@ class Tcategory(db.Model):
     ttype = db.relationship('Ttype', backref='tcategories', lazy='select')
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     user = db.relationship('User', back_populates='tcategories', lazy='select')
+    # partial covering indexes over the active (not soft deleted) categories: the users choice lists
+    # (user_tcategories) and the default category template. deleted (always NULL in the index) is part of the key,
+    # otherwise sqlite does not use the index as covering
+    __table_args__ = (db.Index('ix_tcategory_user_id_ttype_id', 'user_id', 'ttype_id', 'id', 'name', 'deleted',
+                               sqlite_where=text('deleted IS NULL'), postgresql_where=text('deleted IS NULL')),
+                      db.Index('ix_tcategory_default', 'default', 'id', 'name', 'ttype_id', 'deleted',
+                               sqlite_where=text('deleted IS NULL'), postgresql_where=text('deleted IS NULL')))
 
     def __repr__(self):
         return '<Category {}>'.format(self.name)
@@ -95,3 +213,189 @@ class Ttype(db.Model):
 
     def __repr__(self):
         return '<t_type {}>'.format(self.name)
+
+
+# Reference data
+# Lightweight copy of a Ttype / Tcategory row for select fields and titles (kept in reference_cache / tcategory_cache)
+# compares equal to the row with the same id, so QuerySelectFields filled with obj=row mark the right option
+class Choice(namedtuple('Choice', 'id name ttype_id')):
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return getattr(other, 'id', None) == self.id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+UactionSnapshot = namedtuple('UactionSnapshot', 'id name loglevel')
+
+
+# transaction types, loaded once per process (the table only changes with migrations)
+def ttypes():
+    rows = reference_cache.get('ttypes')
+    if rows is None:
+        rows = [Choice(id, name, id) for id, name in db.session.query(Ttype.id, Ttype.name).order_by(Ttype.id)]
+        reference_cache.set('ttypes', rows)
+    return rows
+
+
+def get_ttype(ttype_id):
+    return next((row for row in ttypes() if row.id == ttype_id), None)
+
+
+# user actions by id, loaded once per process (see invalidate_reference_data)
+def uactions():
+    rows = reference_cache.get('uactions')
+    if rows is None:
+        rows = {row.id: UactionSnapshot(*row) for row in db.session.query(Uaction.id, Uaction.name, Uaction.loglevel)}
+        reference_cache.set('uactions', rows)
+    return rows
+
+
+# call after changes of ttype / uaction rows (other workers pick them up after REFERENCE_CACHE_TTL)
+def invalidate_reference_data():
+    reference_cache.delete('ttypes')
+    reference_cache.delete('uactions')
+
+
+# active categories of a user and transaction type, from the tcategory_cache LRU
+# the key contains a per user version (in the page cache backend, shared between workers if configured)
+def user_tcategories(user_id, ttype_id):
+    key = f"{user_id}:{page_cache.backend.version(f'tcategories:{user_id}')}"
+    rows = tcategory_cache.get(key)
+    if rows is None:
+        rows = [Choice(*row) for row in db.session.query(Tcategory.id, Tcategory.name, Tcategory.ttype_id)
+                                                  .filter_by(user_id=user_id, deleted=None)
+                                                  .order_by(Tcategory.ttype_id, Tcategory.id)]
+        tcategory_cache.set(key, rows)
+    return [row for row in rows if row.ttype_id == ttype_id]
+
+
+# call after changes of the users categories (add, edit, delete)
+def invalidate_user_tcategories(user_id):
+    page_cache.backend.bump(f'tcategories:{user_id}')
+
+
+# Default categories
+# (name, ttype_id) of the default categories, cached instead of scanning tcategory for every new user
+def default_tcategory_template(connection):
+    template = default_tcategory_cache.get('template')
+    if template is None:
+        table = Tcategory.__table__
+        template = [tuple(row) for row in connection.execute(
+            select([table.c.name, table.c.ttype_id]).where(and_(table.c.default == True, table.c.deleted.is_(None)))
+                                                    .order_by(table.c.id))]
+        default_tcategory_cache.set('template', template)
+    return template
+
+
+# call after changes of default categories (other workers pick them up after DEFAULT_TCATEGORY_CACHE_TTL)
+def invalidate_default_tcategories():
+    default_tcategory_cache.delete('template')
+
+
+# copy the default categories to new users (one executemany for all users)
+def copy_default_tcategories(connection, user_ids):
+    rows = [dict(name=name, ttype_id=ttype_id, user_id=user_id, default=False)
+            for user_id in user_ids for name, ttype_id in default_tcategory_template(connection)]
+    if rows:
+        connection.execute(Tcategory.__table__.insert(), rows)
+
+
+# Model events
+# actions to be carried out after user creation
+@event.listens_for(User, 'after_insert')
+def after_insert_listener(mapper, connection, target):
+    # copy default tcategories to user after user is created
+    copy_default_tcategories(connection, [target.id])
+
+
+# actions to be carried out after user deletion
+@event.listens_for(User, 'after_delete')
+def after_delete_listener(mapper, connection, target):
+    invalidate_user(target.id)
+    # users attachments are deleted in the background after the commit (see purge_deleted_users)
+    object_session(target).info.setdefault('deleted_users', set()).add(target.id)
+    # deletion of users child db objects like transactions & categories is covered by db functionality
+    # see models.py (large users: helpers.delete_user)
+
+
+def purge_user_files(job, path):
+    job.progress = path
+    shutil.rmtree(path, ignore_errors=True)
+
+
+@event.listens_for(Session, 'after_commit')
+def purge_deleted_users(session):
+    for user_id in session.info.pop('deleted_users', ()):
+        background_jobs.submit(f'purge receipts of user {user_id}', purge_user_files,
+                               current_app.config['UPLOADED_RECEIPTS_DEST'] + str(user_id))
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_deleted_users(session):
+    session.info.pop('deleted_users', None)
+
+
+# keep the monthly_category_total rollup in sync with inserted, changed and deleted transactions
+# a concurrent transaction can insert the same month between the UPDATE and the INSERT: the INSERT runs in a savepoint
+# and the UPDATE is repeated when it fails on the primary key (the other row is committed by then)
+def update_monthly_total(connection, user_id, date, tcategory_id, amount, count):
+    table = MonthlyCategoryTotal.__table__
+    key = and_(table.c.user_id == user_id, table.c.year == date.year, table.c.month == date.month,
+               table.c.tcategory_id == tcategory_id)
+    update = table.update().where(key).values(total=table.c.total + amount, count=table.c.count + count)
+    result = connection.execute(update)
+    if result.rowcount == 0:
+        savepoint = connection.begin_nested()
+        try:
+            connection.execute(table.insert().values(user_id=user_id, year=date.year, month=date.month,
+                                                     tcategory_id=tcategory_id, total=amount, count=count))
+            savepoint.commit()
+        except IntegrityError:
+            savepoint.rollback()
+            connection.execute(update)
+    if count < 0:
+        # drop empty months
+        connection.execute(table.delete().where(and_(key, table.c.count <= 0)))
+
+
+# count the transactions referencing a receipt file (files without references are removed by cleanup_receipts)
+def update_receipt_refcount(connection, attachment_name, count):
+    if attachment_name:
+        table = Receipt.__table__
+        connection.execute(table.update().where(table.c.name == attachment_name)
+                                .values(refcount=table.c.refcount + count, modified=func.now()))
+
+
+@event.listens_for(Transaction, 'after_insert')
+def transaction_insert_listener(mapper, connection, target):
+    update_monthly_total(connection, target.user_id, target.date, target.tcategory_id, target.amount or 0, 1)
+    update_receipt_refcount(connection, target.attachment_name, 1)
+
+
+@event.listens_for(Transaction, 'after_update')
+def transaction_update_listener(mapper, connection, target):
+    attrs = db.inspect(target).attrs
+    history = attrs['attachment_name'].history
+    if history.has_changes():
+        update_receipt_refcount(connection, history.deleted[0] if history.deleted else None, -1)
+        update_receipt_refcount(connection, target.attachment_name, 1)
+    columns = ('user_id', 'date', 'tcategory_id', 'amount')
+    if not any(attrs[column].history.has_changes() for column in columns):
+        return
+    # values before the update are kept in the attribute history
+    user_id, date, tcategory_id, amount = (attrs[column].history.deleted[0] if attrs[column].history.deleted
+                                           else getattr(target, column) for column in columns)
+    update_monthly_total(connection, user_id, date, tcategory_id, -(amount or 0), -1)
+    update_monthly_total(connection, target.user_id, target.date, target.tcategory_id, target.amount or 0, 1)
+
+
+@event.listens_for(Transaction, 'after_delete')
+def transaction_delete_listener(mapper, connection, target):
+    update_monthly_total(connection, target.user_id, target.date, target.tcategory_id, -(target.amount or 0), -1)
+    update_receipt_refcount(connection, target.attachment_name, -1)
@@ -0,0 +1,74 @@
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from workers import PerProcess
+
+
+# Password hashing (werkzeug) in a bounded process pool
+# the request threads only wait for the result, the CPU bound hashing does not hold the GIL of the worker.
+# workers = 0 hashes in the calling thread (CLI commands, benchmarks). At most max_pending hashes are queued,
+# requests beyond wait up to timeout seconds and then fail with 503 instead of piling up.
+# A pool whose process died (e.g. killed by the OOM killer) is broken for good: it is discarded, the next hash starts
+# a new one and the hashes of the failed calls are computed in the calling thread.
+class PasswordHasher(object):
+    def __init__(self, method='pbkdf2:sha256:50000', salt_length=8, workers=0, max_pending=64, timeout=10):
+        self.method = method
+        self.salt_length = salt_length
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pool = PerProcess(self.start_pool)
+        self.pending = None
+
+    def start_pool(self):
+        self.pending = threading.BoundedSemaphore(self.max_pending)
+        return ProcessPoolExecutor(max_workers=self.workers)
+
+    def executor(self):
+        return self.pool.get()
+
+    def discard(self, executor):
+        self.pool.discard(executor)
+        executor.shutdown(wait=False)
+
+    def run(self, function, *args):
+        if not self.workers:
+            return function(*args)
+        executor = self.executor()
+        # released to the semaphore it was acquired from, a new pool gets a new one
+        pending = self.pending
+        if not pending.acquire(timeout=self.timeout):
+            raise ServiceUnavailable('Too many logins at the moment, please try again')
+        try:
+            return executor.submit(function, *args).result()
+        except BrokenProcessPool:
+            self.discard(executor)
+            return function(*args)
+        finally:
+            pending.release()
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, self.method, self.salt_length)
+
+    # several hashes at once (bulk user provisioning), spread over the pool
+    def hash_many(self, passwords):
+        arguments = ([self.method] * len(passwords), [self.salt_length] * len(passwords))
+        if not self.workers:
+            return list(map(generate_password_hash, passwords, *arguments))
+        executor = self.executor()
+        try:
+            return list(executor.map(generate_password_hash, passwords, *arguments,
+                                     chunksize=max(len(passwords) // (self.workers * 4), 1)))
+        except BrokenProcessPool:
+            self.discard(executor)
+            return list(map(generate_password_hash, passwords, *arguments))
+
+    def check(self, password_hash, password):
+        return self.run(check_password_hash, password_hash, password)
+
+    # hash created with another method or cost than the configured one (werkzeug: "<method>$<salt>$<hash>")
+    def needs_rehash(self, password_hash):
+        return password_hash.split('$', 1)[0] != self.method
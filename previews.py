@@ -0,0 +1,92 @@
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from workers import PerProcess
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.webp')
+# exif orientation -> rotation (phone photos are stored unrotated)
+ORIENTATION_ROTATION = {3: 180, 6: 270, 8: 90}
+
+
+# file name of a downscaled variant, stored next to the original ("<name>.<variant>.jpg")
+def variant_name(name, variant):
+    return f'{name}.{variant}.jpg'
+
+
+def is_image(name):
+    return os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+
+
+# write the missing variants of an image (sizes: variant -> max. width / height)
+def make_previews(path, sizes, quality=80):
+    # Pillow is only imported by the workers
+    from PIL import Image
+    missing = {variant: size for variant, size in sizes.items() if not os.path.exists(variant_name(path, variant))}
+    if not missing:
+        return
+    with Image.open(path) as original:
+        try:
+            rotation = ORIENTATION_ROTATION.get((original._getexif() or {}).get(274))
+        except (AttributeError, KeyError, IndexError, SyntaxError):
+            rotation = None
+        # decode at reduced size where the format supports it (jpeg)
+        original.draft('RGB', (max(missing.values()), max(missing.values())))
+        image = original.convert('RGB')
+    if rotation:
+        image = image.rotate(rotation, expand=True)
+    for variant, size in sorted(missing.items(), key=lambda item: -item[1]):
+        image.thumbnail((size, size), Image.LANCZOS)
+        # unique temp file per job (the same receipt may be uploaded again while its previews are written)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                image.save(out, 'JPEG', quality=quality, optimize=True, progressive=True)
+            os.replace(temp_path, variant_name(path, variant))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+
+# Background preview generation in a local thread pool (image decoding and resizing release the GIL)
+# uploads only queue the job, templates fall back to the original until the variant exists
+# (one job per file at a time, uploads of a file with a queued / running job are skipped)
+class PreviewGenerator(object):
+    def __init__(self, sizes=None, quality=80, workers=2):
+        self.sizes = sizes or {}
+        self.quality = quality
+        self.workers = workers
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.pool = PerProcess(self.start_pool)
+
+    def start_pool(self):
+        # jobs of the parent process do not run here
+        self.pending = set()
+        return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='receipt-preview')
+
+    def executor(self):
+        return self.pool.get()
+
+    def submit(self, path):
+        if not self.sizes or not is_image(path):
+            return None
+        executor = self.executor()
+        with self.lock:
+            if path in self.pending:
+                return None
+            self.pending.add(path)
+        return executor.submit(self.run, path)
+
+    def run(self, path):
+        try:
+            make_previews(path, self.sizes, self.quality)
+        except Exception:
+            logger.exception('creating previews of %s failed', path)
+        finally:
+            with self.lock:
+                self.pending.discard(path)
@@ -0,0 +1,116 @@
+import threading
+import time
+from array import array
+
+
+# Sliding window counter: one slot per bucket of window / buckets seconds, reused round robin
+# (count and absolute bucket number per slot in two small arrays instead of a timestamp per attempt)
+class RingCounter(object):
+    __slots__ = ('counts', 'buckets')
+
+    def __init__(self, size):
+        self.counts = array('I', [0]) * size
+        self.buckets = array('q', [-1]) * size
+
+    def add(self, bucket):
+        slot = bucket % len(self.counts)
+        if self.buckets[slot] != bucket:
+            self.buckets[slot] = bucket
+            self.counts[slot] = 0
+        self.counts[slot] += 1
+
+    def total(self, bucket):
+        oldest = bucket - len(self.counts) + 1
+        return sum(count for count, slot_bucket in zip(self.counts, self.buckets) if slot_bucket >= oldest)
+
+    def latest(self):
+        return max(self.buckets)
+
+
+# In-process backend (counts are per worker process - use SharedBackend to share them between workers)
+class LocalBackend(object):
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def hit(self, key, bucket, size, window):
+        with self.lock:
+            counter = self.counters.get(key)
+            if counter is None:
+                if len(self.counters) >= self.max_keys:
+                    self.prune(bucket, size)
+                counter = self.counters[key] = RingCounter(size)
+            counter.add(bucket)
+
+    def count(self, key, bucket, size):
+        with self.lock:
+            counter = self.counters.get(key)
+            return counter.total(bucket) if counter is not None else 0
+
+    # drop counters without hits in the window (all counters if that is not enough)
+    def prune(self, bucket, size):
+        self.counters = {key: counter for key, counter in self.counters.items() if counter.latest() > bucket - size}
+        if len(self.counters) >= self.max_keys:
+            self.counters.clear()
+
+
+# Shared backend on top of a redis like client (incr, expire, mget), one expiring key per bucket
+class SharedBackend(object):
+    def __init__(self, client, prefix='budgy:throttle:'):
+        self.client = client
+        self.prefix = prefix
+
+    def hit(self, key, bucket, size, window):
+        name = f'{self.prefix}{key}:{bucket}'
+        self.client.incr(name)
+        self.client.expire(name, window)
+
+    def count(self, key, bucket, size):
+        values = self.client.mget([f'{self.prefix}{key}:{b}' for b in range(bucket - size + 1, bucket + 1)])
+        return sum(int(value) for value in values if value is not None)
+
+
+# Failed login throttle per email and per client ip (sliding window of window seconds)
+class LoginThrottle(object):
+    def __init__(self, backend, window=300, buckets=10, email_limit=10, ip_limit=50, log_interval=60):
+        self.backend = backend
+        self.window = window
+        self.buckets = buckets
+        self.email_limit = email_limit
+        self.ip_limit = ip_limit
+        # throttled attempts are counted and reported once per key and log_interval
+        self.log_interval = log_interval
+        self.throttled = {}
+        self.lock = threading.Lock()
+
+    def bucket(self):
+        return int(time.time() * self.buckets / self.window)
+
+    def blocked(self, email, ip):
+        bucket = self.bucket()
+        return (self.backend.count('email:' + email.lower(), bucket, self.buckets) >= self.email_limit or
+                self.backend.count('ip:' + ip, bucket, self.buckets) >= self.ip_limit)
+
+    def failed(self, email, ip):
+        bucket = self.bucket()
+        self.backend.hit('email:' + email.lower(), bucket, self.buckets, self.window)
+        self.backend.hit('ip:' + ip, bucket, self.buckets, self.window)
+
+    # count a rejected attempt, returns the number of attempts to write to the user log or None
+    # (the first attempt right away, further attempts summed up per log_interval with the next attempt after it)
+    def rejected(self, email, ip):
+        key = (email.lower(), ip)
+        now = time.time()
+        with self.lock:
+            if key not in self.throttled:
+                if len(self.throttled) >= 10000:
+                    self.throttled = {k: v for k, v in self.throttled.items() if now - v[1] < self.log_interval}
+                self.throttled[key] = (0, now)
+                return 1
+            count, since = self.throttled[key]
+            if now - since >= self.log_interval:
+                self.throttled[key] = (0, now)
+                return count + 1
+            self.throttled[key] = (count + 1, since)
+        return None
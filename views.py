@@ -0,0 +1,513 @@
+import codecs
+import mimetypes
+import os
+from array import array
+from datetime import datetime, date
+from operator import attrgetter
+from flask import Blueprint, current_app, flash, redirect, render_template, url_for, abort, request, \
+    send_from_directory, safe_join, jsonify, Response, stream_with_context
+from flask_login import login_required, current_user
+from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileAllowed, FileRequired
+from sqlalchemy import func, and_, or_
+from sqlalchemy.orm import joinedload
+from wtforms import StringField, SubmitField, HiddenField, FloatField
+from wtforms.fields.html5 import DateField, DecimalField
+from wtforms.validators import InputRequired, Length, Optional, ValidationError
+# check wtforms patch for QuerySelectField -> https://github.com/wtforms/wtforms/issues/373
+from wtforms.ext.sqlalchemy.fields import QuerySelectField
+
+from extensions import db, page_cache, uploaded_receipts, receipt_previews
+from models import Transaction, Ttype, Tcategory, MonthlyCategoryTotal, cents, ttypes, get_ttype, user_tcategories, \
+    invalidate_user_tcategories, amount_in_range, MAX_AMOUNT
+from helpers import add_user_log, cached_page, month_range, user_transactions, parse_month, period_label, \
+    encode_cursor, decode_cursor, month_groups, parse_date, export_rows, EXPORT_FORMATS, import_transactions, \
+    save_receipt, receipt_variant_url
+
+main = Blueprint('main', __name__)
+
+
+# Flask Form classes
+# amounts are stored as integer cents (see Money in models.py): no NaN / infinity, at most MAX_AMOUNT
+def valid_amount(form, field):
+    if field.data is not None and not amount_in_range(field.data):
+        raise ValidationError(f'Amount must be a number between -{MAX_AMOUNT} and {MAX_AMOUNT}')
+
+
+# Transaction Edit
+class EditTransactionForm(FlaskForm):
+    id = HiddenField("Transaction ID")
+    ttype_id = HiddenField("Transaction Type ID")
+    # choices (cached Choice rows, see models.py) are set in the route(s)
+    tcategory = QuerySelectField('Category', validators=[InputRequired()], get_pk=attrgetter('id'), get_label='name')
+    date = DateField('Date', format='%Y-%m-%d', default=date.today, render_kw={"placeholder": "Amount"})
+    amount = DecimalField('Amount', validators=[InputRequired(), valid_amount], render_kw={"placeholder": "00.00"})
+    details = StringField('Details', validators=[Optional()], render_kw={"placeholder": "Details"})
+    attachment = FileField('Receipt', validators=[Optional(), FileAllowed(uploaded_receipts, 'Only Images & Docs!')])
+    geo_lat = FloatField('Latitude', validators=[Optional()], render_kw={"placeholder": "0.0"})
+    geo_lng = FloatField('Longitude', validators=[Optional()], render_kw={"placeholder": "0.0"})
+    submit = SubmitField('Submit')
+
+
+# Transaction Category Edit
+class EditTCategegoryForm(FlaskForm):
+    id = HiddenField('TCategory ID')
+    # choices (cached Choice rows, see models.py) are set in the route(s)
+    ttype = QuerySelectField('Transaction Type', get_pk=attrgetter('id'), get_label='name')
+    name = StringField('Category Name', validators=[InputRequired(), Length(min=1, max=100)],
+                       render_kw={"placeholder": 'My new category'})
+    submit = SubmitField('Submit')
+
+
+# Transaction Import
+class ImportTransactionsForm(FlaskForm):
+    file = FileField('CSV file', validators=[FileRequired(), FileAllowed(['csv', 'txt'], 'Only CSV files!')])
+    submit = SubmitField('Import')
+
+
+# Routes
+# protect users receipts from beeing viewed by anonymous or other logged in users or admins
+@main.route('/static/uploads/Receipts/<sub_dir>/<filename>', methods=['GET'])
+@login_required
+def send_img(sub_dir, filename):
+    # only provide access dir receipt if current user id is identical to subdir name
+    if sub_dir != str(current_user.id):
+        abort(403)
+    path = os.path.join(current_app.config['UPLOADED_RECEIPTS_DEST'], sub_dir)
+    if current_app.config['RECEIPTS_SENDFILE'] == 'x-accel-redirect':
+        # nginx serves the file from an internal location (incl. ranges and etags), see ReverseProxied
+        if not os.path.isfile(safe_join(path, filename)):
+            abort(404)
+        response = current_app.response_class(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = current_app.config['RECEIPTS_ACCEL_REDIRECT'] + f'{sub_dir}/{filename}'
+    else:
+        # X-Sendfile header (USE_X_SENDFILE) or sent by the worker with etag / if-none-match and range support
+        response = send_from_directory(path, filename, conditional=True,
+                                       cache_timeout=current_app.config['RECEIPTS_CACHE_MAX_AGE'])
+    # receipt names are content addressed (and only visible to their owner): long, but private caching
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.max_age = current_app.config['RECEIPTS_CACHE_MAX_AGE']
+    return response
+
+
+@main.route('/category_add', methods=['GET', 'POST'])
+@login_required
+def category_add():
+
+    form = EditTCategegoryForm()
+    #  Set forms Ttype QuerySelectField
+    form.ttype.query = ttypes()
+
+    if form.validate_on_submit():
+        row = Tcategory(default=False, name=form.name.data, ttype_id=form.ttype.data.id, user_id=current_user.id)
+        db.session.add(row)
+        db.session.commit()
+        page_cache.bump(current_user.id)
+        invalidate_user_tcategories(current_user.id)
+        add_user_log(8, f'tcategory_id: {row.id}')
+        flash('Category added')
+        return redirect(url_for('.category_overview'))
+
+    return render_template('category_edit.html', title='Add category', form=form)
+
+
+@main.route('/category_edit/<int:tcategory_id>', methods=['GET', 'POST'])
+@login_required
+def category_edit(tcategory_id):
+
+    row = Tcategory.query.filter_by(id=tcategory_id, deleted=None).first_or_404()
+
+    if row.user_id == current_user.id:
+        form = EditTCategegoryForm(obj=row)
+        form.ttype.query = [get_ttype(row.ttype_id)]
+
+        if form.validate_on_submit():
+            row.name = form.name.data
+            db.session.add(row)
+            db.session.commit()
+            page_cache.bump(current_user.id)
+            invalidate_user_tcategories(current_user.id)
+            add_user_log(9, f'tcategory_id: {row.id}')
+            flash('Category changed')
+
+            return redirect(url_for('.category_overview'))
+    else:
+        abort(403)
+
+    return render_template('category_edit.html', title='Add category', form=form, edit=True)
+
+
+@main.route('/category_del/<int:tcategory_id>', methods=['GET'])
+@login_required
+def category_del(tcategory_id):
+
+    row = Tcategory.query.filter_by(id=tcategory_id).first_or_404()
+
+    if row.user_id == current_user.id:
+        row.deleted = func.now()
+        db.session.add(row)
+        db.session.commit()
+        page_cache.bump(current_user.id)
+        invalidate_user_tcategories(current_user.id)
+        add_user_log(10, f'tcategory_id: {row.id}')
+        flash('Category deleted')
+        return redirect(url_for('.category_overview'))
+    else:
+        abort(403)
+
+
+@main.route('/category_overview', methods=['GET'])
+@login_required
+def category_overview():
+
+    rows = Tcategory.query.options(joinedload(Tcategory.ttype))\
+                          .filter_by(user_id=current_user.id, deleted=None).all()
+
+    return render_template('category_overview.html', title='Category Overview', rows=rows)
+
+
+@main.route('/transaction_add/<int:ttype_id>', methods=['GET', 'POST'])
+@login_required
+def transaction_add(ttype_id):
+
+    # Verify transaction type exists
+    if get_ttype(ttype_id) is None:
+        abort(404)
+    # Set form
+    form = EditTransactionForm()
+    # Set forms Tcategory QuerySelectField
+    form.tcategory.query = user_tcategories(current_user.id, ttype_id)
+
+    if form.validate_on_submit():
+        # change operator for expenditure
+        if ttype_id == 2:
+            form.amount.data = -form.amount.data
+        # set attachment variables (in case no attachment is added)
+        attachment_name = None
+        attachment_url = None
+        # process attachment
+        if form.attachment.data:
+            attachment_name = save_receipt(current_user.id, request.files['attachment'])
+            attachment_url = uploaded_receipts.url(attachment_name)
+        # add new record
+        row = Transaction(date=form.date.data, user_id=current_user.id,
+                          tcategory_id=form.tcategory.data.id,
+                          amount=form.amount.data, details=form.details.data,
+                          attachment_name=attachment_name, attachment_url=attachment_url,
+                          geo_lat=form.geo_lat.data, geo_lng=form.geo_lng.data)
+        db.session.add(row)
+        db.session.commit()
+        page_cache.bump(current_user.id)
+        if form.attachment.data:
+            receipt_previews.submit(os.path.join(current_app.config['UPLOADED_RECEIPTS_DEST'], attachment_name))
+        # logging + user info
+        add_user_log(5, f'transaction_id: {row.id}')
+        flash('Transaction added')
+
+        return redirect(url_for('.index'))
+
+    return render_template('transaction_edit.html', title='Add transaction', form=form, ttype_id=ttype_id,
+                           google_maps_api_key=current_app.config['GOOGLE_MAPS_API_KEY'])
+
+
+@main.route('/transaction_edit/<int:transaction_id>', methods=['GET', 'POST'])
+@login_required
+def transaction_edit(transaction_id):
+
+    row = Transaction.query.options(joinedload(Transaction.tcategory)).filter_by(id=transaction_id).first_or_404()
+
+    if row.user_id == current_user.id:
+        if row.tcategory.ttype_id == 2:
+            row.amount = abs(row.amount)
+        row.ttype_id = row.tcategory.ttype_id
+        form = EditTransactionForm(obj=row)
+        form.tcategory.query = user_tcategories(current_user.id, row.tcategory.ttype_id)
+
+        if form.validate_on_submit():
+            if int(form.ttype_id.data) == 2:
+                form.amount.data = -form.amount.data
+            # set attachment variables (in case no attachment is added)
+            attachment_name = row.attachment_name
+            attachment_url = row.attachment_url
+            # process attachment
+            if form.attachment.data:
+                attachment_name = save_receipt(current_user.id, request.files['attachment'])
+                attachment_url = uploaded_receipts.url(attachment_name)
+            row.tcategory_id = form.tcategory.data.id
+            row.date = form.date.data
+            row.details = form.details.data
+            row.attachment_name = attachment_name
+            row.attachment_url = attachment_url
+            row.amount = form.amount.data
+            row.geo_lat = form.geo_lat.data
+            row.geo_lng = form.geo_lng.data
+            row.modified = func.now()
+            db.session.add(row)
+            db.session.commit()
+            page_cache.bump(current_user.id)
+            if form.attachment.data:
+                receipt_previews.submit(os.path.join(current_app.config['UPLOADED_RECEIPTS_DEST'], attachment_name))
+            add_user_log(6, f'transaction_id: {row.id}')
+            flash('Transaction changed')
+            return redirect(url_for('.index'))
+
+        return render_template('transaction_edit.html', title='Change transaction', form=form, edit=True,
+                               attachment_name=row.attachment_name, attachment_url=row.attachment_url,
+                               thumb_url=receipt_variant_url(row.attachment_name, 'thumb'),
+                               google_maps_api_key=current_app.config['GOOGLE_MAPS_API_KEY'])
+    else:
+        abort(403)
+
+
+@main.route('/transaction_delete/<int:transaction_id>', methods=['GET'])
+@login_required
+def transaction_delete(transaction_id):
+
+    row = Transaction.query.filter_by(id=transaction_id).first_or_404()
+
+    if row.user_id == current_user.id:
+
+        db.session.delete(row)
+        db.session.commit()
+        page_cache.bump(current_user.id)
+        add_user_log(7, f'transaction_id: {row.id}')
+        flash('Transaction deleted')
+        return redirect(url_for('.index'))
+
+    else:
+        abort(403)
+
+
+# bulk import of transactions from a csv file (columns as in the export)
+@main.route('/transaction_import', methods=['GET', 'POST'])
+@login_required
+def transaction_import():
+
+    form = ImportTransactionsForm()
+
+    if form.validate_on_submit():
+        # the upload is decoded and parsed line by line
+        try:
+            imported, errors = import_transactions(current_user.id,
+                                                   codecs.iterdecode(form.file.data.stream, 'utf-8-sig'))
+        except ValueError as e:
+            # nothing has been imported
+            flash(f'Import failed: {e}')
+            return render_template('transaction_import.html', title='Import transactions', form=form)
+        for line_number, error in errors[:10]:
+            flash(f'Line {line_number} skipped: {error}')
+        flash(f'{imported} transactions imported')
+        return redirect(url_for('.transaction_overview'))
+
+    return render_template('transaction_import.html', title='Import transactions', form=form)
+
+
+@main.route('/transaction_view/<int:transaction_id>', methods=['GET'])
+@login_required
+def transaction_view(transaction_id):
+
+    row = Transaction.query.options(joinedload(Transaction.tcategory)).filter_by(id=transaction_id).first_or_404()
+
+    if row.user_id == current_user.id:
+        if row.tcategory.ttype_id == 2:
+            row.amount = abs(row.amount)
+        row.ttype_id = row.tcategory.ttype_id
+        form = EditTransactionForm(obj=row)
+        form.tcategory.query = user_tcategories(current_user.id, row.tcategory.ttype_id)
+
+        return render_template('transaction_detail.html', title='View transaction', form=form, transaction_id=row.id,
+                               attachment_name=row.attachment_name, attachment_url=row.attachment_url,
+                               preview_url=receipt_variant_url(row.attachment_name, 'preview'),
+                               google_maps_api_key=current_app.config['GOOGLE_MAPS_API_KEY'])
+    else:
+        abort(403)
+
+
+@main.route('/transaction_overview/', defaults={'ttype_id': None}, methods=['GET'])
+@main.route('/transaction_overview/<int:ttype_id>', methods=['GET'])
+@login_required
+@cached_page
+def transaction_overview(ttype_id):
+
+    if ttype_id:
+        ttype = get_ttype(ttype_id)
+        if ttype is None:
+            abort(404)
+        title = ttype.name
+    else:
+        title = 'Overview'
+
+    if ttype_id:
+        start, end = month_range(datetime.now().year, datetime.now().month)
+        query = user_transactions(current_user.id, ttype_id, start, end)
+    else:
+        query = user_transactions(current_user.id)
+
+    # keyset pagination over (date, id) - only load rows older than the cursor
+    rows = query
+    cursor = request.args.get('before')
+    if cursor:
+        cursor_date, cursor_id = decode_cursor(cursor)
+        rows = rows.filter(or_(Transaction.date < cursor_date,
+                               and_(Transaction.date == cursor_date, Transaction.id < cursor_id)))
+    page_size = current_app.config['OVERVIEW_PAGE_SIZE']
+    rows = rows.options(joinedload(Transaction.tcategory))\
+               .order_by(Transaction.date.desc(), Transaction.id.desc()).limit(page_size + 1).all()
+    next_cursor = encode_cursor(rows[page_size - 1]) if len(rows) > page_size else None
+    rows = rows[:page_size]
+
+    return render_template('transaction_overview.html', title=title, months=month_groups(query, rows),
+                           ttype_id=ttype_id, next_cursor=next_cursor)
+
+
+@main.route('/')
+@login_required
+def index():
+
+    return redirect(url_for('.chart_actual_month'))
+
+
+@main.route('/chart_actual_month/', defaults={'ttype_id': None}, methods=['GET'])
+@main.route('/chart_actual_month/<int:ttype_id>', methods=['GET'])
+@login_required
+@cached_page
+def chart_actual_month(ttype_id, chart_id='chart_ID', chart_type='column', chart_height=350):
+
+    if not ttype_id:
+        ttype_id = 2
+    ttype = get_ttype(ttype_id)
+    if ttype is None:
+        abort(404)
+    ttype_name = ttype.name
+    title = 'Overview ' + ttype_name + ' actual month'
+
+    # db query - total expenditures per category for current user and actual month (from the rollup table)
+    rows = db.session.query(Tcategory.name, cents(MonthlyCategoryTotal.total).label('total_cents'))\
+                     .join(MonthlyCategoryTotal.tcategory)\
+                     .filter(MonthlyCategoryTotal.user_id == current_user.id,
+                             MonthlyCategoryTotal.year == datetime.now().year,
+                             MonthlyCategoryTotal.month == datetime.now().month, Tcategory.ttype_id == ttype_id)\
+                     .order_by(MonthlyCategoryTotal.tcategory_id).all()
+
+    # convert data for high charts (totals summed as integer cents)
+    totals = array('q', (abs(row.total_cents) if ttype_id == 2 else row.total_cents for row in rows))
+    lst_data = [total / 100 for total in totals]
+    lst_categories = [row.name for row in rows]
+
+    # chart parameters
+    chart = {"renderTo": chart_id, "type": chart_type, "height": chart_height, }
+    series = [{"name": 'Actual month', "data": lst_data}]
+    chart_title = {"text": 'Expenditures ' + datetime.now().strftime("%B-%Y")}
+    chart_subtitle = {'text': 'Total spent actual:' + str(sum(totals) / 100)}
+    x_axis = {"categories": lst_categories}
+    y_axis = {"title": {"text": 'Amount'}}
+
+    # render chart
+    return render_template('chart.html', title=title, chartID=chart_id, chart=chart, series=series,
+                           chart_title=chart_title, chart_subtitle=chart_subtitle, xAxis=x_axis, yAxis=y_axis)
+
+
+@main.route('/cache_stats', methods=['GET'])
+@login_required
+def cache_stats():
+    if current_user.level != 'admin':
+        abort(403)
+    return jsonify(page_cache.stats())
+
+
+# longest range of the analytics api (the response has one value per period and category)
+MAX_ANALYTICS_MONTHS = 50 * 12
+
+
+# totals per category and period as highcharts config (see static/chart.js), answered by one grouped query
+# start / end: "YYYY-MM" (inclusive, at most MAX_ANALYTICS_MONTHS), defaults to the last 12 months
+@main.route('/api/analytics/<period>/', defaults={'ttype_id': None}, methods=['GET'])
+@main.route('/api/analytics/<period>/<int:ttype_id>', methods=['GET'])
+@login_required
+def api_analytics(period, ttype_id, chart_id='chart_ID', chart_type='column', chart_height=350):
+
+    if period not in ('month', 'quarter', 'year', 'rolling12'):
+        abort(404)
+    if request.args.get('end'):
+        end = parse_month(request.args['end'])
+    else:
+        end = datetime.now().year, datetime.now().month
+    end_index = end[0] * 12 + end[1] - 1
+    if request.args.get('start') and period != 'rolling12':
+        start = parse_month(request.args['start'])
+        start_index = start[0] * 12 + start[1] - 1
+    else:
+        start_index = end_index - 11
+    if start_index > end_index or end_index - start_index >= MAX_ANALYTICS_MONTHS:
+        abort(400)
+
+    # group keys of the period, rolling 12 months is one period over the whole range
+    year = MonthlyCategoryTotal.year
+    month = MonthlyCategoryTotal.month
+    keys = {'month': [year, month.label('period_month')],
+            'quarter': [year, ((month - 1) / 3 * 3 + 1).label('period_month')],
+            'year': [year], 'rolling12': []}[period]
+    month_index = year * 12 + month - 1
+    query = db.session.query(*keys, Ttype.name.label('ttype_name'), Tcategory.name,
+                             cents(func.sum(MonthlyCategoryTotal.total)).label('total_cents'))\
+                      .join(MonthlyCategoryTotal.tcategory).join(Tcategory.ttype)\
+                      .filter(MonthlyCategoryTotal.user_id == current_user.id,
+                              year >= start_index // 12, year <= end_index // 12,
+                              month_index >= start_index, month_index <= end_index)
+    if ttype_id:
+        query = query.filter(Tcategory.ttype_id == ttype_id)
+    rows = query.group_by(*keys, Ttype.id, Ttype.name, Tcategory.id, Tcategory.name)\
+                .order_by(*keys, Ttype.id, Tcategory.id).all()
+
+    # x-axis: every period of the range (including periods without transactions), label -> position
+    if period == 'rolling12':
+        periods = [f'{start_index // 12}-{start_index % 12 + 1:02d} - {end_index // 12}-{end_index % 12 + 1:02d}']
+    else:
+        periods = []
+        for index in range(start_index, end_index + 1):
+            periods.append(period_label(period, index // 12, index % 12 + 1))
+    # consecutive months of a quarter / year share the label
+    periods = [label for index, label in enumerate(periods) if index == 0 or label != periods[index - 1]]
+    period_index = {label: index for index, label in enumerate(periods)}
+
+    # one series per category (integer cents per period), expenditures as absolute values if only expenditures
+    # are requested
+    series = {}
+    for row in rows:
+        name = row.name if ttype_id else f'{row.ttype_name}: {row.name}'
+        data = series.get(name)
+        if data is None:
+            data = series[name] = array('q', [0]) * len(periods)
+        if period == 'rolling12':
+            label = periods[0]
+        else:
+            label = period_label(period, row.year, getattr(row, 'period_month', 1))
+        data[period_index[label]] += abs(row.total_cents) if ttype_id == 2 else row.total_cents
+    total = sum(sum(data) for data in series.values()) / 100
+    series = [{"name": name, "data": [value / 100 for value in data]} for name, data in series.items()]
+    ttype_name = rows[0].ttype_name if ttype_id and rows else 'Transactions'
+
+    return jsonify(chart={"renderTo": chart_id, "type": chart_type, "height": chart_height, },
+                   title={"text": f'{ttype_name} per {"rolling 12 months" if period == "rolling12" else period}'},
+                   subtitle={'text': 'Total: ' + str(total)},
+                   xAxis={"categories": periods},
+                   yAxis={"title": {"text": 'Amount'}},
+                   series=series)
+
+
+# streamed export of the users transactions (csv or ndjson)
+# start / end: "YYYY-MM-DD", start inclusive, end exclusive
+@main.route('/export/transactions.<fmt>', methods=['GET'])
+@login_required
+def transaction_export(fmt):
+
+    if fmt not in EXPORT_FORMATS:
+        abort(404)
+    stream, mimetype = EXPORT_FORMATS[fmt]
+    start = parse_date(request.args['start']) if request.args.get('start') else None
+    end = parse_date(request.args['end']) if request.args.get('end') else None
+    rows = export_rows(current_user.id, start, end)
+    headers = {'Content-Disposition': f'attachment; filename=transactions.{fmt}'}
+    # the request context (db session, current_user) is kept until the last chunk has been sent
+    return Response(stream_with_context(stream(rows)), mimetype=mimetype, headers=headers)
@@ -0,0 +1,46 @@
+import os
+import threading
+
+
+# Background thread / pool of the current process, started lazily by get() and again in forked worker processes
+# (threads and pools do not survive a fork). factory() creates it, alive(value) (optional) tells whether it is
+# still usable, e.g. a thread which has not ended
+class PerProcess(object):
+    def __init__(self, factory, alive=None):
+        self.factory = factory
+        self.alive = alive
+        self.lock = threading.Lock()
+        self.value = None
+        self.pid = None
+
+    def get(self):
+        if not self.usable():
+            with self.lock:
+                if not self.usable():
+                    self.value = self.factory()
+                    self.pid = os.getpid()
+        return self.value
+
+    # value of this process if it has been started (and is usable), without starting it
+    def current(self):
+        return self.value if self.usable() else None
+
+    # drop value (e.g. a broken pool) if it is still the current one, the next get() starts a new one
+    def discard(self, value):
+        with self.lock:
+            if self.value is value:
+                self.value = None
+
+    def usable(self):
+        return self.value is not None and self.pid == os.getpid() and (self.alive is None or self.alive(self.value))
+
+
+# daemon thread running target, as PerProcess factory
+def start_thread(target, name):
+    thread = threading.Thread(target=target, name=name, daemon=True)
+    thread.start()
+    return thread
+
+
+def thread_alive(thread):
+    return thread.is_alive()
@@ -0,0 +1,4 @@
+# WSGI entry point (gunicorn wsgi:app, FLASK_APP=wsgi.py flask db upgrade)
+from application import create_app
+
+app = create_app()